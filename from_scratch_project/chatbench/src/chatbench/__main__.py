@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+
+from chatbench import http_bench, tcp_bench, ws_bench
+from chatbench.stats import compare, raise_fd_limit, write_result
+
+
+def _add_chat_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--senders", type=int, default=10, help="有多少个客户端在发消息")
+    parser.add_argument("--messages", type=int, default=20, help="每个发送者发多少条")
+    parser.add_argument("--interval", type=float, default=0.05, help="同一发送者两条消息的间隔（秒）")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--server-pid", type=int, help="读取服务端 RSS 用")
+    parser.add_argument("--out", help="结果写入这个 JSON 文件")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="chatbench")
+    sub = parser.add_subparsers(dest="target", required=True)
+
+    ws = sub.add_parser("ws", help="chatroomwss MyWebSS")
+    ws.add_argument("--url", default="ws://127.0.0.1:8099")
+    _add_chat_args(ws)
+
+    tcp = sub.add_parser("tcp", help="chatroomtcp MyTCPserver")
+    tcp.add_argument("--host", default="127.0.0.1")
+    tcp.add_argument("--port", type=int, default=8099)
+    _add_chat_args(tcp)
+
+    http = sub.add_parser("http", help="simple_http_server MyHTTPRequestHandler")
+    http.add_argument("--url", default="http://127.0.0.1:8090/status")
+    http.add_argument("--concurrency", type=int, default=100)
+    http.add_argument("--requests", type=int, default=10000)
+    http.add_argument("--keep-alive", action="store_true")
+    http.add_argument("--timeout", type=float, default=10.0)
+    http.add_argument("--server-pid", type=int)
+    http.add_argument("--out")
+
+    cmp_ = sub.add_parser("compare", help="对比两次结果")
+    cmp_.add_argument("old")
+    cmp_.add_argument("new")
+
+    args = parser.parse_args()
+    if args.target == "compare":
+        compare(args.old, args.new)
+        return
+
+    raise_fd_limit()
+    params = {k: v for k, v in vars(args).items() if k not in ("target", "out")}
+    if args.target == "ws":
+        results = asyncio.run(
+            ws_bench.run(
+                args.url,
+                args.clients,
+                args.senders,
+                args.messages,
+                args.interval,
+                args.connect_concurrency,
+                args.timeout,
+                args.server_pid,
+            )
+        )
+    elif args.target == "tcp":
+        results = asyncio.run(
+            tcp_bench.run(
+                args.host,
+                args.port,
+                args.clients,
+                args.senders,
+                args.messages,
+                args.interval,
+                args.connect_concurrency,
+                args.timeout,
+                args.server_pid,
+            )
+        )
+    else:
+        results = asyncio.run(
+            http_bench.run(
+                args.url,
+                args.concurrency,
+                args.requests,
+                args.keep_alive,
+                args.timeout,
+                args.server_pid,
+            )
+        )
+    write_result(args.out, args.target, params, results)
+
+
+if __name__ == "__main__":
+    main()
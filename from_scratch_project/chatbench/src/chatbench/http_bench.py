@@ -0,0 +1,102 @@
+import asyncio
+import time
+import urllib.parse
+from typing import List, Optional, Tuple
+
+from chatbench.stats import latency_summary, rss_bytes
+
+
+async def _read_response(reader: asyncio.StreamReader) -> Tuple[Optional[int], bool]:
+    """读完一个响应，返回 (状态码, 服务端是否要求关连接)；连接被关掉时状态码为 None"""
+    status_line = await reader.readline()
+    if not status_line:
+        return None, True
+    status = int(status_line.split()[1])
+    length = None
+    close = False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value.strip())
+        elif name == "connection" and value.strip().lower() == "close":
+            close = True
+    if length is not None:
+        await reader.readexactly(length)
+    else:
+        # HTTP/1.0 没有 Content-Length：读到对端关闭为止
+        await reader.read()
+        close = True
+    return status, close
+
+
+async def run(
+    url: str,
+    concurrency: int,
+    requests: int,
+    keep_alive: bool,
+    timeout: float,
+    server_pid: Optional[int] = None,
+) -> dict:
+    parsed = urllib.parse.urlsplit(url)
+    host, port = parsed.hostname, parsed.port or 80
+    path = parsed.path or "/"
+    connection = "keep-alive" if keep_alive else "close"
+    request = (
+        f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: {connection}\r\n\r\n"
+    ).encode()
+
+    latencies: List[float] = []
+    errors = 0
+    connects = 0
+    remaining = requests
+    rss_before = rss_bytes(server_pid)
+
+    async def worker():
+        nonlocal remaining, errors, connects
+        reader = writer = None
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(host, port)
+                    connects += 1
+                writer.write(request)
+                await writer.drain()
+                status, close = await asyncio.wait_for(_read_response(reader), timeout)
+                if status is None or status >= 500:
+                    errors += 1
+                else:
+                    latencies.append(time.perf_counter() - start)
+                if not keep_alive or close:
+                    writer.close()
+                    writer = None
+            except (OSError, asyncio.IncompleteReadError, TimeoutError, ValueError, IndexError):
+                errors += 1
+                if writer is not None:
+                    writer.close()
+                writer = None
+        if writer is not None:
+            writer.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - t0
+    rss_after = rss_bytes(server_pid)
+
+    return {
+        "latency": latency_summary(latencies),
+        "throughput": {
+            "requests": requests,
+            "ok": len(latencies),
+            "errors": errors,
+            "connections_opened": connects,
+            "seconds": seconds,
+            "requests_per_sec": len(latencies) / seconds if seconds else None,
+        },
+        "rss": {"before_bytes": rss_before, "after_bytes": rss_after},
+    }
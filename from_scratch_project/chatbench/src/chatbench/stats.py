@@ -0,0 +1,101 @@
+import json
+import resource
+import subprocess
+import time
+from typing import Dict, List, Optional
+
+
+def raise_fd_limit():
+    # 几千个连接会超过默认的 1024 个文件描述符
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(samples_s: List[float]) -> Dict[str, Optional[float]]:
+    """秒 -> 毫秒的 p50/p90/p99/max"""
+    ms = [s * 1000 for s in samples_s]
+    return {
+        "count": len(ms),
+        "p50_ms": percentile(ms, 50),
+        "p90_ms": percentile(ms, 90),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": max(ms) if ms else None,
+    }
+
+
+def rss_bytes(pid: Optional[int]) -> Optional[int]:
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_result(path: Optional[str], target: str, params: dict, results: dict):
+    record = {
+        "target": target,
+        "git_commit": git_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "params": params,
+        "results": results,
+    }
+    text = json.dumps(record, indent=2, ensure_ascii=False)
+    print(text)
+    if path:
+        with open(path, "w") as f:
+            f.write(text + "\n")
+    return record
+
+
+def _flatten(prefix: str, value, out: dict):
+    if isinstance(value, dict):
+        for key, sub in value.items():
+            _flatten(f"{prefix}.{key}" if prefix else key, sub, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+
+
+def compare(old_path: str, new_path: str):
+    """逐项打印两次结果的数值差异"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_flat, new_flat = {}, {}
+    _flatten("", old["results"], old_flat)
+    _flatten("", new["results"], new_flat)
+    print(f"{'metric':40} {old.get('git_commit') or 'old':>14} {new.get('git_commit') or 'new':>14} {'change':>9}")
+    for key in sorted(set(old_flat) | set(new_flat)):
+        a, b = old_flat.get(key), new_flat.get(key)
+        change = ""
+        if a not in (None, 0) and b is not None:
+            change = f"{(b - a) / a * 100:+.1f}%"
+        fmt = lambda v: "-" if v is None else f"{v:.3f}" if isinstance(v, float) else str(v)
+        print(f"{key:40} {fmt(a):>14} {fmt(b):>14} {change:>9}")
@@ -0,0 +1,113 @@
+import asyncio
+import re
+import secrets
+import time
+from typing import List, Optional
+
+from chatbench.stats import latency_summary, rss_bytes
+
+MARK = "bench"
+# MyTCPserver 广播格式：[时间] [user 昵称] says 内容
+_SAYS = re.compile(rf"says ({MARK}:\d+:[\d.]+)")
+
+
+async def run(
+    host: str,
+    port: int,
+    clients: int,
+    senders: int,
+    messages: int,
+    interval: float,
+    connect_concurrency: int,
+    timeout: float,
+    server_pid: Optional[int] = None,
+) -> dict:
+    tag = secrets.token_hex(3)
+    rss_before = rss_bytes(server_pid)
+    sem = asyncio.Semaphore(connect_concurrency)
+
+    async def open_client(i: int):
+        async with sem:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout
+            )
+            await reader.readline()  # "pls enter your name:"
+            writer.write(f"b{tag}{i}\n".encode())
+            await writer.drain()
+            return reader, writer
+
+    t0 = time.perf_counter()
+    opened = await asyncio.gather(
+        *(open_client(i) for i in range(clients)), return_exceptions=True
+    )
+    connect_seconds = time.perf_counter() - t0
+    conns = [c for c in opened if not isinstance(c, BaseException)]
+    failed = len(opened) - len(conns)
+    # 服务端按 recv(1024) 读，昵称和第一条消息不能粘在一起
+    await asyncio.sleep(0.5)
+    rss_after = rss_bytes(server_pid)
+
+    latencies: List[float] = []
+    expected = len(conns) * min(senders, len(conns)) * messages
+    done = asyncio.Event()
+
+    async def reader_task(reader: asyncio.StreamReader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            match = _SAYS.search(line.decode("utf-8", "replace"))
+            if match:
+                latencies.append(time.perf_counter() - float(match.group(1).split(":")[2]))
+                if len(latencies) >= expected:
+                    done.set()
+
+    readers = [asyncio.create_task(reader_task(r)) for r, _ in conns]
+
+    async def sender(idx: int, writer: asyncio.StreamWriter):
+        for _ in range(messages):
+            try:
+                writer.write(f"{MARK}:{idx}:{time.perf_counter():.9f}\n".encode())
+                await writer.drain()
+            except OSError:
+                return
+            await asyncio.sleep(interval)
+
+    t_send = time.perf_counter()
+    await asyncio.gather(*(sender(i, w) for i, (_, w) in enumerate(conns[:senders])))
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    except TimeoutError:
+        pass
+    send_seconds = time.perf_counter() - t_send
+
+    for task in readers:
+        task.cancel()
+    for _, writer in conns:
+        writer.close()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    sent = min(senders, len(conns)) * messages
+    return {
+        "connect": {
+            "clients": clients,
+            "failed": failed,
+            "seconds": connect_seconds,
+            "per_sec": len(conns) / connect_seconds if connect_seconds else None,
+        },
+        "fanout_latency": latency_summary(latencies),
+        "throughput": {
+            "sent": sent,
+            "delivered": len(latencies),
+            "expected": expected,
+            "sent_per_sec": sent / send_seconds,
+            "delivered_per_sec": len(latencies) / send_seconds,
+        },
+        "rss": {
+            "before_bytes": rss_before,
+            "after_bytes": rss_after,
+            "per_connection_bytes": (rss_after - rss_before) / len(conns)
+            if rss_before and rss_after and conns
+            else None,
+        },
+    }
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import secrets
+import time
+from typing import Dict, List, Optional
+
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed
+
+from chatbench.stats import latency_summary, rss_bytes
+
+MARK = "bench"
+
+
+async def run(
+    url: str,
+    clients: int,
+    senders: int,
+    messages: int,
+    interval: float,
+    connect_concurrency: int,
+    timeout: float,
+    server_pid: Optional[int] = None,
+) -> dict:
+    """模拟 clients 个浏览器：welcome -> 昵称 -> ping -> senders 个人发消息，其余人只收"""
+    tag = secrets.token_hex(3)
+    rss_before = rss_bytes(server_pid)
+    sem = asyncio.Semaphore(connect_concurrency)
+
+    async def open_client(i: int):
+        async with sem:
+            ws = await connect(url, max_size=None, open_timeout=timeout)
+            await ws.recv()  # welcome
+            await ws.send(json.dumps({"nickname": f"b{tag}{i}"}))
+            return ws
+
+    t0 = time.perf_counter()
+    opened = await asyncio.gather(
+        *(open_client(i) for i in range(clients)), return_exceptions=True
+    )
+    connect_seconds = time.perf_counter() - t0
+    conns = [ws for ws in opened if not isinstance(ws, BaseException)]
+    failed = len(opened) - len(conns)
+    await asyncio.sleep(0.5)
+    rss_after = rss_bytes(server_pid)
+
+    latencies: List[float] = []
+    ping_rtts: List[float] = []
+    ping_sent: Dict[int, float] = {}
+    expected = len(conns) * min(senders, len(conns)) * messages
+    done = asyncio.Event()
+
+    async def reader(idx: int, ws):
+        try:
+            async for raw in ws:
+                data = json.loads(raw)
+                kind = data.get("type")
+                if kind == "message" and data.get("content", "").startswith(MARK):
+                    sent_at = float(data["content"].split(":")[2])
+                    latencies.append(time.perf_counter() - sent_at)
+                    if len(latencies) >= expected:
+                        done.set()
+                elif kind == "pong" and idx in ping_sent:
+                    ping_rtts.append(time.perf_counter() - ping_sent.pop(idx))
+        except ConnectionClosed:
+            pass
+
+    readers = [asyncio.create_task(reader(i, ws)) for i, ws in enumerate(conns)]
+
+    for i, ws in enumerate(conns):
+        ping_sent[i] = time.perf_counter()
+        await ws.send(json.dumps({"type": "ping"}))
+    await asyncio.sleep(0.5)
+
+    async def sender(idx: int, ws):
+        for _ in range(messages):
+            await ws.send(
+                json.dumps({"content": f"{MARK}:{idx}:{time.perf_counter():.9f}"})
+            )
+            await asyncio.sleep(interval)
+
+    t_send = time.perf_counter()
+    await asyncio.gather(*(sender(i, ws) for i, ws in enumerate(conns[:senders])))
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    except TimeoutError:
+        pass
+    send_seconds = time.perf_counter() - t_send
+
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(
+        *(ws.close() for ws in conns), *readers, return_exceptions=True
+    )
+
+    sent = min(senders, len(conns)) * messages
+    return {
+        "connect": {
+            "clients": clients,
+            "failed": failed,
+            "seconds": connect_seconds,
+            "per_sec": len(conns) / connect_seconds if connect_seconds else None,
+        },
+        "fanout_latency": latency_summary(latencies),
+        "ping_rtt": latency_summary(ping_rtts),
+        "throughput": {
+            "sent": sent,
+            "delivered": len(latencies),
+            "expected": expected,
+            "sent_per_sec": sent / send_seconds,
+            "delivered_per_sec": len(latencies) / send_seconds,
+        },
+        "rss": {
+            "before_bytes": rss_before,
+            "after_bytes": rss_after,
+            "per_connection_bytes": (rss_after - rss_before) / len(conns)
+            if rss_before and rss_after and conns
+            else None,
+        },
+    }
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+
+class TokenBucket():
+    """`rate` messages per second, up to `burst` saved up; rate <= 0 means unlimited."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now=None):
+        """Seconds until a token is available; 0 means one is available now."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+def reserve_all(buckets, max_delay):
+    """Reserve a token from every bucket and return how long to wait before
+    sending. Returns None, reserving nothing, if that would exceed max_delay.
+
+    Tokens may go negative: a message admitted with a delay has already
+    reserved its token, so the next one waits correspondingly longer.
+    """
+    now = time.monotonic()
+    delay = max(bucket.wait_time(now) for bucket in buckets)
+    if delay > max_delay:
+        return None
+    for bucket in buckets:
+        bucket.take()
+    return delay
+
+
+async def throttle(*buckets, max_delay):
+    """Take a token from every bucket, sleeping until they have one.
+
+    Returns (admitted, waited). Gives up without taking anything when the
+    wait would exceed max_delay.
+    """
+    waited = 0.0
+    while True:
+        delay = max(bucket.wait_time() for bucket in buckets)
+        if delay == 0:
+            for bucket in buckets:
+                bucket.take()
+            return True, waited
+        if waited + delay > max_delay:
+            return False, waited
+        await asyncio.sleep(delay)
+        waited += delay
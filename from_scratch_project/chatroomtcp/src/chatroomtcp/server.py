@@ -1,25 +1,53 @@
+import asyncio
 import socket
 import socketserver
+import sys
 import sqlite3
+import time
 from datetime import datetime
 from socketserver import BaseServer
 import threading
 
+try:
+    from .ratelimit import TokenBucket, reserve_all, throttle
+except ImportError:
+    # run as a script: python server.py
+    from ratelimit import TokenBucket, reserve_all, throttle
+
 def _now():
     return datetime.now().__str__()[:23]
 
+
+_THROTTLED_NOTICE = "[server] you are sending too fast, message dropped\n".encode('utf-8')
+
+
 class MyTCPserver():
     address_family = socket.AF_INET
     socket_type = socket.SOCK_STREAM
     request_queue_size = 5
     clients_lock = threading.Lock()
     clients = []  # [(conn, nickname), ...]
+    # Flood control: one bucket per connection and one per nickname. A
+    # client a little over the limit is slowed down (its thread sleeps
+    # instead of reading, so TCP pushes back); further over, messages are
+    # dropped.
+    message_rate = 5
+    message_burst = 20
+    nick_rate = 10
+    nick_burst = 40
+    max_throttle_delay = 1.0
+    # the throttled counters are printed every stats_interval seconds when
+    # they have changed; 0 turns the report off
+    stats_interval = 60
 
     def __init__(self, address, port):
         self.server_address = address
         self.server_port = port
         self.socket = socket.socket(self.address_family,
                                     self.socket_type)
+        self.nick_lock = threading.Lock()
+        self.nick_buckets = {}  # {nickname: TokenBucket}
+        self.throttled = {"delayed": 0, "dropped": 0}
     
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -58,8 +86,15 @@ class MyTCPserver():
                 self.clients.append((conn, nickname))
                 msg = f"[user {nickname}] has entered the chat"
                 self._broadcast(msg, nickname)
+            bucket = TokenBucket(self.message_rate, self.message_burst)
             while True:
-                data = conn.recv(1024).decode('utf-8').strip()
+                raw = conn.recv(1024)
+                if not raw:
+                    # peer closed; recv() would keep returning b"" forever
+                    break
+                data = raw.decode('utf-8').strip()
+                if not self._admit(conn, bucket, nickname):
+                    continue
                 msg = f"[user {nickname}] says {data}"
                 self._broadcast(msg, nickname)
                 print(f"[DEBUG] [user {nickname}] says {data}")
@@ -77,7 +112,39 @@ class MyTCPserver():
                 print(f"[DEBUG] [user {nickname}] has left the chat")
             conn.close()
 
+    def _admit(self, conn, bucket, nickname):
+        with self.nick_lock:
+            nick_bucket = self.nick_buckets.get(nickname)
+            if nick_bucket is None:
+                nick_bucket = self.nick_buckets[nickname] = TokenBucket(
+                    self.nick_rate, self.nick_burst)
+            delay = reserve_all((bucket, nick_bucket), self.max_throttle_delay)
+            if delay:
+                self.throttled["delayed"] += 1
+            elif delay is None:
+                self.throttled["dropped"] += 1
+        if delay is None:
+            print(f"[DEBUG] [user {nickname}] is flooding, message dropped")
+            conn.send(_THROTTLED_NOTICE)
+            return False
+        if delay:
+            time.sleep(delay)
+        return True
+
+    def _report_stats_forever(self):
+        with self.nick_lock:
+            last = dict(self.throttled)
+        while True:
+            time.sleep(self.stats_interval)
+            with self.nick_lock:
+                current = dict(self.throttled)
+            if current != last:
+                print(f"[DEBUG] throttled messages: {current}")
+                last = current
+
     def handle_clients_forever(self):
+        if self.stats_interval > 0:
+            threading.Thread(target=self._report_stats_forever, daemon=True).start()
         try:
             while True:
                 conn, addr = self.socket.accept()
@@ -97,12 +164,140 @@ class MyTCPserver():
             print(f" {user} _broadcast err with {e}")
         return 
 
-        
+
+
+class MyAsyncTCPserver():
+    """Same chat protocol as MyTCPserver, but on one asyncio event loop.
+
+    No thread per client: every connection is a coroutine reading lines, and
+    _broadcast only appends to each client's transport buffer instead of
+    blocking in send(). A client whose unsent output grows past
+    max_write_buffer is dropped, so one stuck peer can't stall the room.
+
+    Inbound messages go through the same per-connection and per-nickname
+    token buckets as MyTCPserver. While a connection waits for a token it
+    isn't read, and the StreamReader stops reading the socket once
+    max_line bytes are buffered, so a flooding client gets TCP backpressure.
+    """
+
+    def __init__(self, address, port, backlog=1024,
+                 max_write_buffer=1 << 20, max_line=65536,
+                 message_rate=5, message_burst=20, nick_rate=10, nick_burst=40,
+                 max_throttle_delay=1.0, stats_interval=60):
+        self.server_address = address
+        self.server_port = port
+        self.request_queue_size = backlog
+        self.max_write_buffer = max_write_buffer
+        self.max_line = max_line
+        self.clients = {}  # {writer: nickname}
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.nick_rate = nick_rate
+        self.nick_burst = nick_burst
+        self.max_throttle_delay = max_throttle_delay
+        self.nick_buckets = {}  # {nickname: TokenBucket}
+        self.throttled = {"delayed": 0, "dropped": 0}
+        self.stats_interval = stats_interval
+
+    async def _report_stats_forever(self):
+        last = dict(self.throttled)
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            if self.throttled != last:
+                print(f"[DEBUG] throttled messages: {self.throttled}")
+                last = dict(self.throttled)
+
+    async def handle_clients(self, reader, writer):
+        nickname = "Guest"
+        writer.write("pls enter your name:".encode('utf-8') + b'\n')
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            data = line.decode('utf-8').strip()
+            if data:
+                nickname = data
+                print(f"[DEBUG] user [user {data}] logging in")
+            self.clients[writer] = nickname
+            self._broadcast(f"[user {nickname}] has entered the chat", nickname)
+            bucket = TokenBucket(self.message_rate, self.message_burst)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                data = line.decode('utf-8').strip()
+                if not await self._admit(writer, bucket, nickname):
+                    continue
+                msg = f"[user {nickname}] says {data}"
+                self._broadcast(msg, nickname)
+                print(f"[DEBUG] [user {nickname}] says {data}")
+        except UnicodeDecodeError as e:
+            print(f"[DEBUG] [user {nickname}] has error {e}")
+        except (ConnectionError, ValueError) as e:
+            # ValueError: line longer than max_line
+            print(f"[DEBUG] [user {nickname}] has error {e}")
+        finally:
+            if self.clients.pop(writer, None) is not None:
+                self._broadcast(f"[user {nickname}] has left the chat", nickname)
+                print(f"[DEBUG] [user {nickname}] has left the chat")
+            writer.close()
+
+    async def _admit(self, writer, bucket, nickname):
+        nick_bucket = self.nick_buckets.get(nickname)
+        if nick_bucket is None:
+            nick_bucket = self.nick_buckets[nickname] = TokenBucket(
+                self.nick_rate, self.nick_burst)
+        admitted, waited = await throttle(
+            bucket, nick_bucket, max_delay=self.max_throttle_delay)
+        if not admitted:
+            self.throttled["dropped"] += 1
+            print(f"[DEBUG] [user {nickname}] is flooding, message dropped")
+            writer.write(_THROTTLED_NOTICE)
+            return False
+        if waited:
+            self.throttled["delayed"] += 1
+        return True
+
+    def _broadcast(self, msg, user):
+        payload = f"[{_now()}] {msg}\n".encode('utf-8')
+        for writer in list(self.clients):
+            transport = writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > self.max_write_buffer:
+                print(f" {self.clients[writer]} is too slow, dropping")
+                transport.abort()
+                continue
+            writer.write(payload)
+
+    async def handle_clients_forever(self):
+        server = await asyncio.start_server(
+            self.handle_clients, self.server_address, self.server_port,
+            backlog=self.request_queue_size, reuse_address=True,
+            limit=self.max_line,
+        )
+        report = None
+        if self.stats_interval > 0:
+            report = asyncio.create_task(self._report_stats_forever())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if report is not None:
+                report.cancel()
+
 
 if __name__ == "__main__":
-    server = MyTCPserver("127.0.0.1", 8099)
-    server.server_bind()
-    server.server_activate()
-    print("[DEBUG] I'm starting a TCP server")
-    server.handle_clients_forever()
+    if len(sys.argv) > 1 and sys.argv[1] == "asyncio":
+        print("[DEBUG] I'm starting an asyncio TCP server")
+        try:
+            asyncio.run(MyAsyncTCPserver("127.0.0.1", 8099).handle_clients_forever())
+        except KeyboardInterrupt:
+            print("\n[!] Closing the server...")
+    else:
+        server = MyTCPserver("127.0.0.1", 8099)
+        server.server_bind()
+        server.server_activate()
+        print("[DEBUG] I'm starting a TCP server")
+        server.handle_clients_forever()
     
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""wire.py 的微基准：JSON（标准库 / orjson）和二进制帧，比较编码、解码耗时和帧大小。
+
+    python bench_wire.py [--count 200000]
+"""
+
+import argparse
+import json
+import time
+
+import wire
+
+NICK = "香啵猪"
+CONTENT = "晚上吃什么？火锅还是烤肉"
+TIME_STAMP = "2026-10-18 19:26:48.105"
+
+
+def _per_op(func, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - start) / count * 1e9
+
+
+def _json_codecs():
+    codecs = {"json": (json.dumps, json.loads)}
+    try:
+        import orjson
+
+        codecs["orjson"] = (lambda obj: orjson.dumps(obj).decode("utf-8"), orjson.loads)
+    except ImportError:
+        pass
+    return codecs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=200000)
+    count = parser.parse_args().count
+
+    payload = {
+        "type": "message",
+        "id": 123456,
+        "nickname": NICK,
+        "content": CONTENT,
+        "timestamp": TIME_STAMP,
+    }
+    inbound_json = json.dumps({"content": CONTENT})
+    inbound_binary = bytes([wire.K_MESSAGE]) + CONTENT.encode("utf-8")
+    nicks = wire.NickTable()
+    ts_ms = wire.timestamp_ms(TIME_STAMP)
+
+    rows = []
+    for name, (dumps, loads) in _json_codecs().items():
+        frame = dumps(payload)
+        rows.append((
+            name,
+            len(frame.encode("utf-8")),
+            _per_op(lambda: dumps(payload), count),
+            # 服务端每条入站消息：解析 + 判断类型 + 取 content
+            _per_op(lambda: loads(inbound_json).get("content"), count),
+        ))
+
+    frame = wire.encode_event(wire.K_MESSAGE, nicks.intern(NICK), 123456, ts_ms, CONTENT)
+    rows.append((
+        "binary",
+        len(frame),
+        _per_op(
+            lambda: wire.encode_event(
+                wire.K_MESSAGE, nicks.intern(NICK), 123456,
+                wire.timestamp_ms(TIME_STAMP), CONTENT,
+            ),
+            count,
+        ),
+        _per_op(
+            lambda: inbound_binary[0] == wire.K_MESSAGE
+            and inbound_binary[1:].decode("utf-8"),
+            count,
+        ),
+    ))
+
+    print(f"{'codec':<8} {'frame bytes':>12} {'encode ns':>10} {'inbound parse ns':>17}")
+    for name, size, enc, dec in rows:
+        print(f"{name:<8} {size:>12} {enc:>10.0f} {dec:>17.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+
+logger = logging.getLogger("websockets")
+
+# 多个 MyWebSS worker 之间转发的消息都是一行 JSON：
+#   {"kind": "hello"}                                  新 worker 上线，请其他人报一下在线用户
+#   {"kind": "presence", "users": [...]}               某个 worker 的本地在线用户
+#   {"kind": "broadcast", "frame": "...", ...}         需要发给所有客户端的帧
+#   {"kind": "kick", "nickname": "...", "join_key": "..."}  同名用户在别的 worker 上线了
+#   {"kind": "worker_gone"}                            hub 发现某个 worker 断开
+# "worker" 字段由发送方（或 hub）填上
+
+OnMessage = Callable[[dict], Awaitable[None]]
+BusAddress = Union[str, Tuple[str, int]]
+
+# hub 转发时等每个 worker 把缓冲区写出去的最长时间；超时说明那个 worker 卡住了，断开它
+HUB_DRAIN_TIMEOUT = 5.0
+
+
+class LocalHub:
+    """同一进程内的多个 LocalBus 共用一个 hub（本地调试、单进程多实例）"""
+
+    def __init__(self):
+        self.members: Dict[str, OnMessage] = {}
+
+
+class LocalBus:
+    def __init__(self, hub: LocalHub):
+        self.hub = hub
+        self.worker_id: Optional[str] = None
+        # 投递任务要留引用，不然可能执行到一半被回收
+        self._tasks = set()
+
+    def _deliver(self, on_message: OnMessage, msg: dict):
+        task = asyncio.create_task(on_message(msg))
+        self._tasks.add(task)
+        task.add_done_callback(self._delivered)
+
+    def _delivered(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Cluster bus message failed: %s", task.exception())
+
+    async def start(self, worker_id: str, on_message: OnMessage):
+        self.worker_id = worker_id
+        self.hub.members[worker_id] = on_message
+
+    async def publish(self, msg: dict):
+        msg = dict(msg, worker=self.worker_id)
+        for worker_id, on_message in list(self.hub.members.items()):
+            if worker_id != self.worker_id:
+                self._deliver(on_message, msg)
+
+    async def close(self):
+        self.hub.members.pop(self.worker_id, None)
+        for on_message in list(self.hub.members.values()):
+            self._deliver(on_message, {"kind": "worker_gone", "worker": self.worker_id})
+
+
+async def _open_connection(address: BusAddress):
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+
+class StreamBus:
+    """连到 run_hub 起的 hub；address 是 UNIX socket 路径，或 (host, port) 走 TCP 跨机器"""
+
+    def __init__(self, address: BusAddress):
+        self.address = address
+        self.worker_id: Optional[str] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, worker_id: str, on_message: OnMessage):
+        self.worker_id = worker_id
+        self._reader, self._writer = await _open_connection(self.address)
+        # 第一行告诉 hub 自己是谁，hub 断线时据此通知其他 worker
+        self._writer.write(json.dumps({"worker": worker_id}).encode() + b"\n")
+        await self._writer.drain()
+        self._task = asyncio.create_task(self._read_loop(on_message))
+
+    async def publish(self, msg: dict):
+        msg = dict(msg, worker=self.worker_id)
+        self._writer.write(json.dumps(msg).encode() + b"\n")
+        await self._writer.drain()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def _read_loop(self, on_message: OnMessage):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                logger.warning("Cluster bus connection lost")
+                return
+            try:
+                await on_message(json.loads(line))
+            except Exception as e:
+                logger.warning("Cluster bus message failed: %s", e)
+
+
+async def start_hub(address: BusAddress) -> asyncio.Server:
+    """hub 只做一件事：把每个 worker 发来的行转发给其他所有 worker"""
+    peers: Dict[asyncio.StreamWriter, str] = {}
+
+    async def drain(writer: asyncio.StreamWriter):
+        try:
+            await asyncio.wait_for(writer.drain(), HUB_DRAIN_TIMEOUT)
+        except (ConnectionError, asyncio.TimeoutError):
+            # 卡住的 worker 断开，它的 on_connect 会收尾并通知其他 worker
+            logger.warning("Cluster hub dropping slow worker %s", peers.get(writer))
+            writer.transport.abort()
+
+    async def relay(line: bytes, sender: asyncio.StreamWriter):
+        targets = [writer for writer in peers if writer is not sender]
+        for writer in targets:
+            if not writer.transport.is_closing():
+                writer.write(line)
+        # 一起等所有 worker 写完再读发送方的下一行，hub 的缓冲不会无限涨
+        await asyncio.gather(*(drain(writer) for writer in targets))
+
+    async def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            hello = await reader.readline()
+            peers[writer] = json.loads(hello)["worker"]
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await relay(line, writer)
+        except (ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            worker_id = peers.pop(writer, None)
+            writer.close()
+            if worker_id is not None:
+                gone = {"kind": "worker_gone", "worker": worker_id}
+                await relay(json.dumps(gone).encode() + b"\n", writer)
+
+    if isinstance(address, str):
+        # 上次没清理干净的 socket 文件
+        if os.path.exists(address):
+            os.unlink(address)
+        return await asyncio.start_unix_server(on_connect, path=address)
+    return await asyncio.start_server(on_connect, *address)
+
+
+async def run_hub(address: BusAddress):
+    """单独跑一个 hub（多台机器时在其中一台上跑，worker 用 (host, port) 连过来）"""
+    server = await start_hub(address)
+    async with server:
+        await server.serve_forever()
+
+
+def _worker_main(host: str, port: int, bus_address: BusAddress, options: dict):
+    from server import MyWebSS
+
+    server = MyWebSS(
+        host, port, bus=StreamBus(bus_address), reuse_port=True, **options
+    )
+    try:
+        asyncio.run(server.start_server())
+    except KeyboardInterrupt:
+        pass
+
+
+def run_cluster(
+    host: str,
+    port: int,
+    workers: int,
+    bus_address: BusAddress = "/tmp/chatroomwss.sock",
+    **options,
+):
+    """本机起 workers 个进程共用同一个端口（SO_REUSEPORT），用 hub 互相转发"""
+
+    # spawn：子进程里重新起事件循环，不继承父进程正在运行的 loop
+    ctx = multiprocessing.get_context("spawn")
+
+    async def main():
+        hub = await start_hub(bus_address)
+        procs = [
+            ctx.Process(
+                target=_worker_main,
+                args=(host, port, bus_address, options),
+                daemon=True,
+            )
+            for _ in range(workers)
+        ]
+        for proc in procs:
+            proc.start()
+        logger.info(f"Started {workers} chat workers on {host}:{port}")
+        try:
+            await asyncio.gather(*(asyncio.to_thread(p.join) for p in procs))
+        finally:
+            hub.close()
+
+    asyncio.run(main())
@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import aiosqlite
+
+# chat.db 的统一入口，聊天服务（server.py）和 HTTP 服务（http_server.py）共用：
+# - connect()：所有长连接都带同一组 PRAGMA（WAL、busy_timeout 等）
+# - MIGRATIONS：按 PRAGMA user_version 顺序执行的建表/改表语句
+# - DBPool：HTTP 服务的连接池，随 app 启动/关闭；一个写连接串行写，几个读连接并发读
+# - 两个服务都会用到的 upsert 语句放在这里，长连接上同一条 SQL 只编译一次
+#   （sqlite3 按连接缓存 prepared statement）
+
+logger = logging.getLogger("websockets")
+
+DB_PATH = os.environ.get("CHATROOM_DB", "chat.db")
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    # 写锁被另一个进程占着时最多等 5 秒，而不是立刻 "database is locked"
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+)
+
+# 下标 + 1 就是执行完之后的 user_version；只能在末尾追加，不要改已有的
+MIGRATIONS: List[List[str]] = [
+    # 1：之前分散在 server._init_db / http_server.init_push_db / ImageStore.init_db 里的表，
+    #    全部 IF NOT EXISTS，老库上执行也没问题
+    [
+        """
+        CREATE TABLE IF NOT EXISTS users_status (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            join_key TEXT NOT NULL,
+            nick_name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            time_stamp TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS message_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            join_key TEXT NOT NULL,
+            nick_name TEXT NOT NULL,
+            message TEXT NOT NULL,
+            time_stamp TEXT NOT NULL
+        )
+        """,
+        # 按 id 翻页直接走主键 B 树；按昵称翻页走这个索引
+        "CREATE INDEX IF NOT EXISTS idx_message_history_nick_id ON message_history (nick_name, id)",
+        # 每个用户最近一次上线/下线时间，由 save_login_status_to_DB 顺带维护
+        """
+        CREATE TABLE IF NOT EXISTS users_last_status (
+            nick_name TEXT PRIMARY KEY,
+            last_login_time TEXT,
+            last_logout_time TEXT
+        )
+        """,
+        # 从历史记录回填；已经有的行不覆盖
+        """
+        INSERT OR IGNORE INTO users_last_status (nick_name, last_login_time, last_logout_time)
+        SELECT nick_name,
+               MAX(CASE WHEN status = 'login' THEN time_stamp END),
+               MAX(CASE WHEN status = 'logout' THEN time_stamp END)
+        FROM users_status
+        GROUP BY nick_name
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS push_subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nick_name TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            p256dh TEXT NOT NULL,
+            auth TEXT NOT NULL,
+            UNIQUE(nick_name, endpoint)
+        )
+        """,
+        # 聊天服务缓存了订阅列表，靠这里的 version 判断缓存是否过期
+        """
+        CREATE TABLE IF NOT EXISTS push_subscription_versions (
+            nick_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS images (
+            digest TEXT PRIMARY KEY,
+            ext TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS image_aliases (
+            image_id TEXT PRIMARY KEY,
+            digest TEXT NOT NULL
+        )
+        """,
+    ],
+    # 2：聊天记录全文索引（用法见 search.py）。external content 表，只存索引不存原文；
+    #    trigram 分词按连续三个字符切，中文不分词也能搜子串。
+    #    靠触发器和 message_history 同步，聊天服务的批量写入不用改；老数据用 rebuild 回填。
+    [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+            message,
+            content='message_history',
+            content_rowid='id',
+            tokenize='trigram'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS message_history_fts_insert
+        AFTER INSERT ON message_history BEGIN
+            INSERT INTO message_fts (rowid, message) VALUES (new.id, new.message);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS message_history_fts_delete
+        AFTER DELETE ON message_history BEGIN
+            INSERT INTO message_fts (message_fts, rowid, message)
+            VALUES ('delete', old.id, old.message);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS message_history_fts_update
+        AFTER UPDATE OF message ON message_history BEGIN
+            INSERT INTO message_fts (message_fts, rowid, message)
+            VALUES ('delete', old.id, old.message);
+            INSERT INTO message_fts (rowid, message) VALUES (new.id, new.message);
+        END
+        """,
+        "INSERT INTO message_fts (message_fts) VALUES ('rebuild')",
+    ],
+]
+
+# 上线/下线时间，按 status 选一条
+UPSERT_LAST_STATUS = {
+    "login": (
+        "INSERT INTO users_last_status (nick_name, last_login_time) VALUES (?, ?) "
+        "ON CONFLICT(nick_name) DO UPDATE SET last_login_time = excluded.last_login_time"
+    ),
+    "logout": (
+        "INSERT INTO users_last_status (nick_name, last_logout_time) VALUES (?, ?) "
+        "ON CONFLICT(nick_name) DO UPDATE SET last_logout_time = excluded.last_logout_time"
+    ),
+}
+
+# 同一个 endpoint 重新订阅时更新密钥；内容没变时影响行数为 0
+UPSERT_PUSH_SUBSCRIPTION = """
+    INSERT INTO push_subscriptions (nick_name, endpoint, p256dh, auth)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(nick_name, endpoint) DO UPDATE SET
+        p256dh = excluded.p256dh,
+        auth = excluded.auth
+    WHERE p256dh != excluded.p256dh OR auth != excluded.auth
+"""
+
+BUMP_PUSH_SUBSCRIPTION_VERSION = """
+    INSERT INTO push_subscription_versions (nick_name, version)
+    VALUES (?, 1)
+    ON CONFLICT(nick_name) DO UPDATE SET version = version + 1
+"""
+
+UPSERT_IMAGE_REF = """
+    INSERT INTO images (digest, ext, size, refcount, created_at)
+    VALUES (?, ?, ?, 1, ?)
+    ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1
+"""
+
+
+async def connect(db_path: str = DB_PATH) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(db_path)
+    for pragma in PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+
+async def migrate(conn: aiosqlite.Connection):
+    """把库升级到最新的 user_version；多个进程同时启动时靠 BEGIN IMMEDIATE 排队"""
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        async with conn.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+        for target in range(version + 1, len(MIGRATIONS) + 1):
+            for sql in MIGRATIONS[target - 1]:
+                await conn.execute(sql)
+            await conn.execute(f"PRAGMA user_version = {target}")
+            logger.info("chat.db migrated to version %d", target)
+        await conn.commit()
+    except BaseException:
+        await conn.rollback()
+        raise
+
+
+async def init_db(db_path: str = DB_PATH):
+    conn = await connect(db_path)
+    try:
+        await migrate(conn)
+    finally:
+        await conn.close()
+
+
+class DBPool:
+    """HTTP 服务用的连接池。
+
+    写都走同一个连接、用锁串行（SQLite 同一时刻本来就只有一个写者），
+    读从 readers 个连接里借一个；WAL 下读不会被写或聊天服务的批量提交挡住。
+    """
+
+    def __init__(self, db_path: str = DB_PATH, readers: int = 4):
+        self.db_path = db_path
+        self.readers = readers
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._conns: List[aiosqlite.Connection] = []
+
+    async def open(self):
+        self._writer = await connect(self.db_path)
+        await migrate(self._writer)
+        for _ in range(self.readers):
+            conn = await connect(self.db_path)
+            self._conns.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._conns:
+            await conn.close()
+        self._conns = []
+        self._idle = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        """块里的语句在一个事务里，正常退出 commit，出异常 rollback"""
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
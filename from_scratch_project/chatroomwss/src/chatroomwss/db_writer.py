@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+import aiosqlite
+
+from db import connect
+from metrics import DB_ROWS_TOTAL
+
+logger = logging.getLogger("websockets")
+
+_STOP = object()
+
+
+def _returns_rowid(sql: str) -> bool:
+    # UPSERT 走 UPDATE 分支时 last_insert_rowid() 不变，DELETE/UPDATE 更不会动它
+    sql = sql.lstrip().upper()
+    return sql.startswith("INSERT") and "ON CONFLICT" not in sql
+
+
+def _plan(batch):
+    """把一批写入分成 [(sql, [(params, fut), ...]), ...] 依次执行。
+
+    同一条 INSERT 合并成 executemany，保持各自表内的先后顺序；DELETE/UPDATE 单独成组，
+    并且不和前后的语句调换顺序（比如先删订阅、再重新订阅）。
+    """
+    plan, groups = [], {}
+    for sql, params, fut in batch:
+        if not sql.lstrip().upper().startswith("INSERT"):
+            plan.append((sql, [(params, fut)]))
+            groups = {}
+            continue
+        items = groups.get(sql)
+        if items is None:
+            items = groups[sql] = []
+            plan.append((sql, items))
+        items.append((params, fut))
+    return plan
+
+
+class BatchedDBWriter:
+    """单连接 + 写队列：把多条 INSERT 合并到一次 commit 里（group commit）"""
+
+    def __init__(
+        self,
+        db_path: str,
+        flush_size: int = 100,
+        flush_interval: float = 0.05,
+        max_pending: int = 10000,
+    ):
+        self.db_path = db_path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._db: Optional[aiosqlite.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def start(self):
+        self._db = await connect(self.db_path)
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # 先把队列里剩下的写完再关连接
+        if self._task is not None:
+            await self._queue.put(_STOP)
+            await self._task
+            self._task = None
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def submit(self, sql: str, params: tuple, wait: bool = False):
+        """排队写入；wait=True 时等到 commit 完成。
+
+        普通 INSERT 返回该行的 rowid；UPSERT、DELETE、UPDATE 只等落盘，返回 None。
+        """
+        fut = asyncio.get_running_loop().create_future() if wait else None
+        # 队列满了这里会阻塞，相当于对发送方做背压
+        await self._queue.put((sql, params, fut))
+        if fut is not None:
+            return await fut
+        return None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            has_waiter = item[2] is not None
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.flush_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    # 有人在等落盘就不再攒批；压力大时上一次 commit 期间队列
+                    # 自然会积压，批量依然成立
+                    if has_waiter:
+                        break
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except TimeoutError:
+                        break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                has_waiter = has_waiter or item[2] is not None
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[str, tuple, Optional[asyncio.Future]]]):
+        try:
+            results = []
+            for sql, items in _plan(batch):
+                await self._db.executemany(sql, [params for params, _ in items])
+                if not _returns_rowid(sql):
+                    results.extend((fut, None) for _, fut in items)
+                    continue
+                async with self._db.execute("SELECT last_insert_rowid()") as cursor:
+                    (last_id,) = await cursor.fetchone()
+                # 单写连接 + 同一事务内，AUTOINCREMENT 分配的 id 是连续的
+                first_id = last_id - len(items) + 1
+                for offset, (_, fut) in enumerate(items):
+                    results.append((fut, first_id + offset))
+            await self._db.commit()
+            DB_ROWS_TOTAL.inc(len(batch))
+        except Exception as e:
+            logger.error("DB batch write failed (%d rows): %s", len(batch), e)
+            try:
+                await self._db.rollback()
+            except Exception:
+                pass
+            for _, _, fut in batch:
+                if fut is not None and not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for fut, row_id in results:
+            if fut is not None and not fut.done():
+                fut.set_result(row_id)
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Iterable, Optional
+
+from websockets.exceptions import ConnectionClosed
+
+logger = logging.getLogger("websockets")
+
+# 发送队列满了以后：
+#   drop        丢掉新帧（客户端会漏消息）；
+#   disconnect  断开，客户端重连时补发；
+#   coalesce    在线列表之类带 coalesce_key 的帧随时替换成最新的，队列满了和 disconnect 一样。
+SLOW_CONSUMER_POLICIES = {"drop", "coalesce", "disconnect"}
+
+
+class _ClientQueue:
+    """每个连接一个有界发送队列 + 一个发送协程，慢连接只堵自己"""
+
+    def __init__(self, engine: "FanoutEngine", join_key: str, websocket):
+        self.engine = engine
+        self.join_key = join_key
+        self.ws = websocket
+        self.pending: deque = deque()  # [(frame, coalesce_key), ...]
+        self.sending = False
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._drain())
+
+    def push(self, frame, coalesce_key: Optional[str]) -> None:
+        stats = self.engine.stats
+        if self.pending or self.sending:
+            stats["delayed"] += 1
+
+        # 同类帧（比如在线列表）还没发出去，直接替换成最新的
+        if coalesce_key is not None:
+            for i, (_, key) in enumerate(self.pending):
+                if key == coalesce_key:
+                    self.pending[i] = (frame, coalesce_key)
+                    stats["coalesced"] += 1
+                    return
+
+        if len(self.pending) >= self.engine.max_queue:
+            # coalesce 只替换同类帧；聊天消息不能悄悄丢，队列满了就断开，
+            # 客户端重连时带上 last_id 补发
+            if self.engine.policy == "drop":
+                stats["dropped"] += 1
+                return
+            stats["disconnected"] += 1
+            self.close()
+            self.engine.close_slow(self.ws)
+            return
+
+        self.pending.append((frame, coalesce_key))
+        self._ready.set()
+
+    def close(self) -> None:
+        self.closed = True
+        self.pending.clear()
+        self._task.cancel()
+
+    async def _drain(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self.pending:
+                    frame, _ = self.pending.popleft()
+                    self.sending = True
+                    try:
+                        await self.ws.send(frame)
+                    finally:
+                        self.sending = False
+                    self.engine.stats["sent"] += 1
+                self._ready.clear()
+        except ConnectionClosed:
+            self.closed = True
+            self.pending.clear()
+        except asyncio.CancelledError:
+            pass
+
+
+class FanoutEngine:
+    """广播引擎：一帧只序列化一次，按连接入队后立即返回，不等待慢连接"""
+
+    def __init__(self, max_queue: int = 256, policy: str = "coalesce"):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queues: Dict[str, _ClientQueue] = {}
+        self.stats = {
+            "sent": 0,
+            "delayed": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "disconnected": 0,
+        }
+        # 断开慢连接的 close 任务要留引用，不然可能执行到一半被回收
+        self._closing = set()
+
+    def register(self, join_key: str, websocket) -> None:
+        self.queues[join_key] = _ClientQueue(self, join_key, websocket)
+
+    def unregister(self, join_key: str) -> None:
+        queue = self.queues.pop(join_key, None)
+        if queue is not None:
+            queue.close()
+
+    def close_slow(self, websocket) -> None:
+        task = asyncio.create_task(websocket.close(code=1008, reason="Client too slow"))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def publish(
+        self,
+        frame,
+        join_keys: Iterable[str],
+        coalesce_key: Optional[str] = None,
+    ) -> None:
+        for join_key in join_keys:
+            queue = self.queues.get(join_key)
+            if queue is not None and not queue.closed:
+                queue.push(frame, coalesce_key)
@@ -0,0 +1,84 @@
+import json
+from collections import deque
+from typing import Optional
+
+import aiosqlite
+
+
+def _is_system_text(msg: str) -> bool:
+    # 老数据里混有进出聊天室的系统消息，历史里不展示
+    return "has entered" in msg or "has left" in msg
+
+
+class HistoryCache:
+    """最近 N 条聊天记录的环形缓冲，连接时直接从内存下发，不查 SQLite"""
+
+    def __init__(self, size: int = 50):
+        self.size = size
+        self._items: deque = deque(maxlen=size)
+        self._frame: Optional[str] = None
+
+    async def warm(self, db_path: str):
+        async with aiosqlite.connect(db_path) as db:
+            async with db.execute(
+                "SELECT id, nick_name, message, time_stamp FROM message_history ORDER BY id DESC LIMIT ?",
+                (self.size,),
+            ) as cursor:
+                rows = await cursor.fetchall()
+        self._items.clear()
+        # 从旧到新放进缓冲
+        for msg_id, nick, msg, ts in reversed(rows):
+            if not _is_system_text(msg):
+                self._items.append(
+                    {"id": msg_id, "nickname": nick, "content": msg, "timestamp": ts}
+                )
+        self._frame = None
+
+    def append(self, nickname: str, content: str, timestamp: str, msg_id=None):
+        item = {"id": msg_id, "nickname": nickname, "content": content, "timestamp": timestamp}
+        self._frame = None
+        # 别的 worker 转发来的消息可能比本地已经缓存的 id 小：按 id 插到前面，
+        # 缓冲满了挤掉的始终是 id 最小的那条，不会在中间留洞
+        pos = len(self._items)
+        if msg_id is not None:
+            while pos > 0 and (self._items[pos - 1]["id"] or 0) > msg_id:
+                pos -= 1
+        if pos == len(self._items):
+            self._items.append(item)
+            return
+        if len(self._items) == self.size:
+            if pos == 0:
+                # 比整个窗口都旧
+                return
+            self._items.popleft()
+            pos -= 1
+        self._items.insert(pos, item)
+
+    def newest_id(self) -> Optional[int]:
+        # 集群模式下缓冲里的 id 不一定按顺序，取最大的
+        return max((item["id"] for item in self._items if item["id"] is not None), default=None)
+
+    def since(self, after_id: int, upto: Optional[int] = None) -> Optional[list]:
+        """断线重连补发：id 在 (after_id, upto] 之间的消息，按 id 从旧到新。
+
+        缓冲里最早的一条都比 after_id + 1 新（中间可能有缺）时返回 None，调用方去查库。
+        """
+        items = sorted(
+            (item for item in self._items if item["id"] is not None),
+            key=lambda item: item["id"],
+        )
+        if not items or items[0]["id"] > after_id + 1:
+            return None
+        return [
+            item for item in items
+            if after_id < item["id"] and (upto is None or item["id"] <= upto)
+        ]
+
+    def __len__(self):
+        return len(self._items)
+
+    def frame(self) -> str:
+        """整段历史打包成一帧 history，编码结果缓存到下一次 append"""
+        if self._frame is None:
+            self._frame = json.dumps({"type": "history", "messages": list(self._items)})
+        return self._frame
@@ -0,0 +1,73 @@
+from typing import Optional
+
+# 按 id 做 keyset 翻页（WHERE id < ? ORDER BY id DESC LIMIT ?），不用 OFFSET，
+# 翻到多深都只扫一页的行数
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# 断线重连最多补发这么多条，再多就让客户端丢掉本地记录、重新拉一页历史
+MAX_RESUME_MESSAGES = 500
+
+
+def clamp_page_size(limit) -> int:
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def page_query(before_id: Optional[int], limit: int, nickname: Optional[str] = None):
+    """返回 (sql, params)；多取一行用来判断还有没有更早的记录"""
+    where = []
+    params = []
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(int(before_id))
+    if nickname:
+        where.append("nick_name = ?")
+        params.append(nickname)
+    sql = "SELECT id, nick_name, message, time_stamp FROM message_history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit + 1)
+    return sql, tuple(params)
+
+
+def resume_query(after_id: int, upto: Optional[int], limit: int):
+    """返回 (sql, params)：after_id 之后（到 upto 为止）的记录，从旧到新；多取一行判断是否超限"""
+    sql = "SELECT id, nick_name, message, time_stamp FROM message_history WHERE id > ?"
+    params = [int(after_id)]
+    if upto is not None:
+        sql += " AND id <= ?"
+        params.append(upto)
+    sql += " ORDER BY id ASC LIMIT ?"
+    params.append(limit + 1)
+    return sql, tuple(params)
+
+
+def _to_messages(rows) -> list:
+    return [
+        {"id": msg_id, "nickname": nick, "content": msg, "timestamp": ts}
+        for msg_id, nick, msg, ts in rows
+        # 老数据里的系统消息不展示，但游标仍按原始行推进
+        if "has entered" not in msg and "has left" not in msg
+    ]
+
+
+def build_resume(rows, limit: int) -> Optional[list]:
+    """超过 limit 条返回 None（缺得太多，让客户端重新同步）"""
+    if len(rows) > limit:
+        return None
+    return _to_messages(rows)
+
+
+def build_page(rows, limit: int) -> dict:
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    messages = _to_messages(reversed(rows))
+    return {
+        "messages": messages,
+        "next_before_id": rows[-1][0] if has_more else None,
+        "has_more": has_more,
+    }
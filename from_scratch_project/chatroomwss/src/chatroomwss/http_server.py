@@ -1,19 +1,55 @@
-from fastapi import FastAPI, HTTPException, Response
-import sqlite3
-from typing import List, Dict
-from fastapi import File, UploadFile, Depends, Cookie, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Dict, Optional
+from fastapi import Depends, Cookie, HTTPException
 from fastapi.responses import FileResponse
 import os
-import secrets
 from pathlib import Path
 import urllib.parse
 from pywebpush import webpush, WebPushException
 from push_config import VAPID_PUBLIC_KEY
+from db import BUMP_PUSH_SUBSCRIPTION_VERSION, UPSERT_PUSH_SUBSCRIPTION, DBPool
+from history_page import DEFAULT_PAGE_SIZE, build_page, clamp_page_size, page_query
+from image_store import ImageStore
+from image_upload import UploadError, receive_image
+from image_variants import VARIANT_SIZES, VariantCache
+from search import DEFAULT_SEARCH_LIMIT, run_search
 
 
-app = FastAPI()
+logger = logging.getLogger("uvicorn.error")
+
+# 所有接口共用的 chat.db 连接池，随 app 启动/关闭
+DB = DBPool()
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
+IMAGE_STORE = ImageStore(UPLOAD_DIR, DB)
+IMAGE_VARIANTS = VariantCache(IMAGE_STORE)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 打开连接池时顺带执行 db.MIGRATIONS（建表 / 升级）
+    await DB.open()
+    # 图片仓库：清理残留的临时文件，再把老的平铺文件搬进去（搬过的会跳过）
+    await asyncio.to_thread(IMAGE_STORE.clean_tmp)
+    migrated = await IMAGE_STORE.migrate_legacy()
+    if migrated:
+        logger.info("moved %d legacy images into the content-addressed store", migrated)
+    try:
+        yield
+    finally:
+        await asyncio.to_thread(IMAGE_VARIANTS.close)
+        await DB.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 VALID_USERS = {"tom", "香啵猪"}
 from pydantic import BaseModel
@@ -56,29 +92,50 @@ def login_http(request: LoginRequest, response: Response):
 #    return {"status": "logged in"}
 
 
-def get_last_logout_times() -> List[Dict[str, str]]:
+# last_online_time 被前端轮询，结果在进程内缓存 LAST_ONLINE_TTL 秒
+LAST_ONLINE_TTL = 5.0
+_last_online_cache = {"expires_at": 0.0, "body": b"", "etag": ""}
+_last_online_lock = asyncio.Lock()
+
+
+async def get_last_logout_times() -> List[Dict[str, str]]:
     try:
-        conn = sqlite3.connect("chat.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT nick_name, MAX(time_stamp)
-            FROM users_status
-            WHERE status = 'logout'
-              AND nick_name IN ('tom', '香啵猪')
-            GROUP BY nick_name
-        """
+        placeholders = ", ".join("?" for _ in VALID_USERS)
+        # users_last_status 每个用户一行，按主键查，不再扫整张 users_status
+        rows = await DB.fetchall(
+            f"""
+            SELECT nick_name, last_logout_time
+            FROM users_last_status
+            WHERE last_logout_time IS NOT NULL
+              AND nick_name IN ({placeholders})
+        """,
+            tuple(VALID_USERS),
         )
-        rows = cursor.fetchall()
-        conn.close()
         return [{"nick_name": row[0], "last_logout_time": row[1]} for row in rows]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 
+async def _cached_last_logout_times():
+    async with _last_online_lock:
+        now = time.monotonic()
+        if now >= _last_online_cache["expires_at"]:
+            rows = sorted(await get_last_logout_times(), key=lambda r: r["nick_name"])
+            body = json.dumps(rows, ensure_ascii=False).encode("utf-8")
+            _last_online_cache["body"] = body
+            # ETag 只和内容有关：TTL 过期重查后内容没变，客户端照样拿到 304
+            _last_online_cache["etag"] = '"' + hashlib.sha1(body).hexdigest() + '"'
+            _last_online_cache["expires_at"] = now + LAST_ONLINE_TTL
+        return _last_online_cache["body"], _last_online_cache["etag"]
+
+
 @app.get("/xbzchat/v1/last_online_time")
-def last_online_time():
-    return get_last_logout_times()
+async def last_online_time(request: Request):
+    body, etag = await _cached_last_logout_times()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 def get_current_user(auth_user: str = Cookie(None)) -> str:
     if auth_user is None:
@@ -100,95 +157,161 @@ def get_current_user(auth_user: str = Cookie(None)) -> str:
 #    return auth_user
 
 
-@app.post("/xbzchat/v1/upload_image")
-async def upload_image(
-    image: UploadFile = File(...), user: str = Depends(get_current_user)
+@app.get("/xbzchat/v1/history")
+async def get_history(
+    before_id: Optional[int] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    nickname: Optional[str] = None,
+    user: str = Depends(get_current_user),
+):
+    # keyset 翻页：把上一页返回的 next_before_id 作为 before_id 传回来
+    limit = clamp_page_size(limit)
+    sql, params = page_query(before_id, limit, nickname)
+    try:
+        rows = await DB.fetchall(sql, params)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    return build_page(rows, limit)
+
+
+@app.get("/xbzchat/v1/search")
+async def search_messages(
+    q: str,
+    before_id: Optional[int] = None,
+    limit: int = DEFAULT_SEARCH_LIMIT,
+    nickname: Optional[str] = None,
+    user: str = Depends(get_current_user),
 ):
-    # 安全检查：只允许图片
-    if not image.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="仅支持图片上传")
+    # 结果从新到旧；snippet 里命中的部分用 <mark> 包起来，翻页同 /history
+    try:
+        return await run_search(DB.fetchall, q, before_id, limit, nickname)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-    # 生成唯一文件名（避免冲突）
-    ext = image.filename.split(".")[-1].lower() if "." in image.filename else "jpg"
-    safe_ext = ext if ext in {"jpg", "jpeg", "png", "gif", "webp"} else "jpg"
-    filename = f"{secrets.token_urlsafe(16)}.{safe_ext}"
-    filepath = UPLOAD_DIR / filename
 
-    # 保存文件
-    with open(filepath, "wb") as f:
-        f.write(await image.read())
+@app.post("/xbzchat/v1/upload_image")
+async def upload_image(request: Request, user: str = Depends(get_current_user)):
+    # 表单字段仍然叫 image；不用 UploadFile，自己流式解析请求体：
+    # 边收边落盘、超限即停、按魔数校验类型，见 image_upload.py
+    try:
+        filename = await receive_image(
+            request.headers.get("content-type", ""),
+            request.headers.get("content-length"),
+            request.stream(),
+            IMAGE_STORE,
+        )
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    IMAGE_VARIANTS.prefetch(await IMAGE_STORE.resolve(filename))
 
     # （可选）记录到数据库：谁上传了什么图？这里简化处理
     return {"image_id": filename}
 
 
+# get_image 的 stat 缓存：(image_id, size) -> (路径, stat, ETag)。
+# 同一个 image_id 的内容永远不变，条目不需要过期，只按数量淘汰；
+# 命中时判断 304、拼响应头都不碰文件系统。
+IMAGE_STAT_CACHE_SIZE = 10000
+_image_stat_cache = OrderedDict()
+IMAGE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+async def _stat_image(image_id: str, size: str):
+    filepath = await IMAGE_STORE.resolve(image_id)
+    if filepath is None:
+        return None
+    cacheable = True
+    if size in VARIANT_SIZES:
+        original = filepath
+        filepath = await IMAGE_VARIANTS.get(original, size)
+        # 生成失败退回原图的不缓存，下次再试；GIF 这类本来就不做变体的照常缓存
+        cacheable = filepath != original or IMAGE_VARIANTS.variant_path(original, size) is None
+    try:
+        st = await asyncio.to_thread(os.stat, filepath)
+    except FileNotFoundError:
+        return None
+    # 文件名里就是内容哈希（老文件是随机 token），天然是强 ETag
+    entry = (filepath, st, f'"{filepath.stem}"')
+    if cacheable:
+        _image_stat_cache[(image_id, size)] = entry
+        if len(_image_stat_cache) > IMAGE_STAT_CACHE_SIZE:
+            _image_stat_cache.popitem(last=False)
+    return entry
+
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
 @app.get("/xbzchat/v1/image/{image_id}")
-async def get_image(image_id: str, user: str = Depends(get_current_user)):
+async def get_image(
+    image_id: str,
+    request: Request,
+    size: str = "original",
+    user: str = Depends(get_current_user),
+):
     # 简单安全：只允许合法文件名
     if not image_id.replace(".", "").replace("_", "").replace("-", "").isalnum():
         raise HTTPException(status_code=400, detail="非法文件名")
-
-    filepath = UPLOAD_DIR / image_id
-    if not filepath.exists():
-        raise HTTPException(status_code=404, detail="图片不存在")
-
-    return FileResponse(path = filepath,
-                        headers={"Cache-Control": "private, max-age=259200"})
+    # ?size=thumb|medium 返回缩小、去掉 EXIF 的版本，默认原图
+    if size != "original" and size not in VARIANT_SIZES:
+        raise HTTPException(status_code=400, detail="size 只能是 original/thumb/medium")
+
+    entry = _image_stat_cache.get((image_id, size))
+    if entry is not None:
+        _image_stat_cache.move_to_end((image_id, size))
+    else:
+        entry = await _stat_image(image_id, size)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="图片不存在")
+    filepath, st, etag = entry
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": IMAGE_CACHE_CONTROL,
+    }
+    if _not_modified(request, etag, st.st_mtime):
+        return Response(status_code=304, headers=headers)
+    # 传入 stat_result 就不会再 stat 一次；Range / If-Range 由 FileResponse 处理
+    return FileResponse(path=filepath, stat_result=st, headers=headers)
 
 
 # web push notification
-def init_push_db():
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS push_subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nick_name TEXT NOT NULL,
-            endpoint TEXT NOT NULL,
-            p256dh TEXT NOT NULL,
-            auth TEXT NOT NULL,
-            UNIQUE(nick_name, endpoint)
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-init_push_db()
-
 class PushSubscription(BaseModel):
     endpoint: str
     keys: Dict[str, str]
 
 @app.post("/xbzchat/v1/push/subscribe")
-def push_subscribe(
+async def push_subscribe(
     sub: PushSubscription,
     user: str = Depends(get_current_user)
 ):
     logger.info(f"push_subscribe called by user={user}, endpoint={sub.endpoint}")
-    conn = sqlite3.connect("chat.db")
-    cursor = conn.cursor()
-
-    # 先检查是否存在
-    cursor.execute("""
-        SELECT 1 FROM push_subscriptions
-        WHERE nick_name = ? AND endpoint = ?
-    """, (user, sub.endpoint))
-    exists = cursor.fetchone()
-
-    if not exists:
-        cursor.execute("""
-            INSERT INTO push_subscriptions
-            (nick_name, endpoint, p256dh, auth)
-            VALUES (?, ?, ?, ?)
-        """, (
+    # 一条 upsert 代替先 SELECT 再 INSERT；新订阅或密钥变了才会影响到行
+    async with DB.write() as conn:
+        cursor = await conn.execute(UPSERT_PUSH_SUBSCRIPTION, (
             user,
             sub.endpoint,
             sub.keys["p256dh"],
             sub.keys["auth"],
         ))
-        conn.commit()
+        if cursor.rowcount:
+            # 通知聊天服务的推送缓存：这个用户的订阅变了
+            await conn.execute(BUMP_PUSH_SUBSCRIPTION_VERSION, (user,))
 
-    conn.close()
     return {"status": "ok"}
 
 
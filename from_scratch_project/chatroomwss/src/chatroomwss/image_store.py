@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import os
+import re
+import time
+from pathlib import Path
+from typing import Optional
+
+from db import UPSERT_IMAGE_REF
+from image_upload import sniff_image_type
+
+# 内容寻址的图片仓库：文件按 sha256 存成 <root>/ab/cd/<sha256>.<ext>，
+# 同一张图只存一份，单个目录也不会越长越大。
+# chat.db 的 images 表记每份内容的大小和引用计数（每次上传 +1）；
+# image_aliases 表把老的随机文件名 <token>.<ext> 映射到内容哈希，老链接继续能打开。
+# 这两张表在 db.MIGRATIONS 里建，读写走 HTTP 服务的 DBPool。
+
+IMAGE_EXTS = {"jpg", "jpeg", "png", "gif", "webp"}
+_DIGEST_ID = re.compile(r"^([0-9a-f]{64})\.(jpg|jpeg|png|gif|webp)$")
+HASH_CHUNK = 1024 * 1024
+# 这么久还没收完的临时文件当作垃圾清掉
+STALE_TMP_SECONDS = 3600
+
+
+def hash_file(path: Path) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class ImageStore:
+    def __init__(self, root: Path, db):
+        self.root = Path(root)
+        self.db = db
+        # 和仓库在同一个文件系统上，收完可以直接 rename 进去
+        self.tmp_dir = self.root / ".tmp"
+        # 老 image_id -> 新 image_id；映射建好就不会再变，可以一直缓存
+        self._aliases = {}
+
+    def clean_tmp(self):
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        for path in self.tmp_dir.iterdir():
+            if now - path.stat().st_mtime > STALE_TMP_SECONDS:
+                path.unlink(missing_ok=True)
+
+    def path_for(self, digest: str, ext: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / f"{digest}.{ext}"
+
+    async def add(self, tmp_path: str, digest: str, ext: str, size: int,
+                  alias: Optional[str] = None) -> str:
+        """把收好的文件放进仓库，引用计数 +1，返回新的 image_id（<sha256>.<ext>）。
+
+        同样的内容已经存在时直接丢掉这份；alias 是迁移老文件时原来的文件名，
+        已经迁移过的不重复计数。
+        """
+        async with self.db.write() as conn:
+            counted = True
+            if alias is not None:
+                cursor = await conn.execute(
+                    "INSERT OR IGNORE INTO image_aliases (image_id, digest) VALUES (?, ?)",
+                    (alias, digest),
+                )
+                counted = cursor.rowcount > 0
+            if counted:
+                await conn.execute(
+                    UPSERT_IMAGE_REF,
+                    (digest, ext, size, time.strftime("%Y-%m-%d %H:%M:%S")),
+                )
+            # 以第一次入库时的扩展名为准
+            async with conn.execute(
+                "SELECT ext FROM images WHERE digest = ?", (digest,)
+            ) as cursor:
+                ext = (await cursor.fetchone())[0]
+
+        await asyncio.to_thread(self._place, tmp_path, self.path_for(digest, ext))
+        return f"{digest}.{ext}"
+
+    @staticmethod
+    def _place(tmp_path: str, dest: Path):
+        if dest.exists():
+            os.unlink(tmp_path)
+        else:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, dest)
+
+    async def resolve(self, image_id: str) -> Optional[Path]:
+        """image_id -> 文件路径；新 id 直接算出来，老 id 查一次映射表"""
+        match = _DIGEST_ID.match(image_id)
+        if match:
+            return self.path_for(match.group(1), match.group(2))
+
+        new_id = self._aliases.get(image_id)
+        if new_id is None:
+            row = await self.db.fetchone("""
+                SELECT images.digest, images.ext FROM image_aliases
+                JOIN images ON images.digest = image_aliases.digest
+                WHERE image_aliases.image_id = ?
+            """, (image_id,))
+            if row is None:
+                # 还没迁移的老文件
+                legacy = self.root / image_id
+                return legacy if await asyncio.to_thread(legacy.is_file) else None
+            new_id = self._aliases[image_id] = f"{row[0]}.{row[1]}"
+        return await self.resolve(new_id)
+
+    async def migrate_legacy(self) -> int:
+        """把平铺的老文件 <root>/<token>.<ext> 搬进仓库，可以重复执行"""
+        moved = 0
+        for path in await asyncio.to_thread(list, self.root.iterdir()):
+            ext = path.suffix[1:].lower()
+            if not path.is_file() or path.name.startswith(".") or ext not in IMAGE_EXTS:
+                continue
+            digest, ext, size = await asyncio.to_thread(_inspect_legacy, path, ext)
+            await self.add(str(path), digest, ext, size, alias=path.name)
+            moved += 1
+        return moved
+
+
+def _inspect_legacy(path: Path, ext: str):
+    with open(path, "rb") as f:
+        ext = sniff_image_type(f.read(16)) or ext
+    return hash_file(path), ext, path.stat().st_size
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+# 图片上传：直接解析 multipart 流，边收边写临时文件（写盘放到线程池），
+# 超过大小上限立刻中止；类型看文件头的魔数，不信客户端给的 content_type；
+# 写盘的同时算 sha256，收完 fsync 再交给 ImageStore 原子 rename 进仓库，
+# 仓库里不会出现写了一半的图片。
+
+MAX_IMAGE_SIZE = int(os.environ.get("CHATROOM_MAX_IMAGE_SIZE", 20 * 1024 * 1024))
+# 攒够这么多再写一次盘，少一些线程切换
+WRITE_CHUNK = 256 * 1024
+# multipart 边界、字段头这些额外开销
+FORM_OVERHEAD = 64 * 1024
+
+IMAGE_FIELD = "image"
+
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """按魔数识别图片格式，返回扩展名；不认识返回 None"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+class _ImagePart:
+    """当前这个 multipart 请求里 image 字段的接收状态"""
+
+    def __init__(self, tmp_dir: Path, max_size: int):
+        self.tmp_dir = tmp_dir
+        self.max_size = max_size
+        self.header_field = b""
+        self.headers = {}
+        self.in_image = False
+        self.found = False
+        self.pending = []
+        self.pending_size = 0
+        self.size = 0
+        self.head = b""
+        self.ext = None
+        self.file = None
+        self.hasher = hashlib.sha256()
+
+    # MultipartParser 的回调，都在事件循环里同步调用，只做内存操作
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        name = self.header_field.lower()
+        self.headers[name] = self.headers.get(name, b"") + data[start:end]
+
+    def on_header_end(self):
+        self.header_field = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        self.in_image = not self.found and options.get(b"name") == IMAGE_FIELD.encode()
+        self.found = self.found or self.in_image
+
+    def on_part_data(self, data, start, end):
+        if not self.in_image:
+            return
+        chunk = data[start:end]
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise UploadError(413, f"图片不能超过 {self.max_size // (1024 * 1024)}MB")
+        if self.ext is None:
+            self.head += chunk[:16]
+            if len(self.head) >= 12:
+                self.ext = sniff_image_type(self.head)
+                if self.ext is None:
+                    raise UploadError(400, "仅支持 jpg/png/gif/webp 图片")
+        self.pending.append(chunk)
+        self.pending_size += len(chunk)
+
+    def on_part_end(self):
+        self.in_image = False
+
+    async def flush(self, force: bool = False):
+        if not self.pending or (self.pending_size < WRITE_CHUNK and not force):
+            return
+        data = b"".join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        if self.file is None:
+            self.file = await asyncio.to_thread(
+                tempfile.NamedTemporaryFile,
+                dir=self.tmp_dir, prefix="upload-", delete=False,
+            )
+        await asyncio.to_thread(self._write, data)
+
+    def _write(self, data: bytes):
+        # 大块数据的 sha256 会释放 GIL，和写盘一起放在线程里
+        self.hasher.update(data)
+        self.file.write(data)
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            Path(self.file.name).unlink(missing_ok=True)
+
+
+def _finish(file):
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+
+
+async def receive_image(
+    content_type: str,
+    content_length: Optional[str],
+    stream: AsyncIterator[bytes],
+    store,
+    max_size: int = MAX_IMAGE_SIZE,
+) -> str:
+    """把请求体里的 image 字段存进 store（ImageStore），返回 image_id"""
+    if content_length:
+        try:
+            declared = int(content_length)
+        except ValueError:
+            raise UploadError(400, "Content-Length 无效")
+        if declared > max_size + FORM_OVERHEAD:
+            raise UploadError(413, f"图片不能超过 {max_size // (1024 * 1024)}MB")
+    mimetype, options = parse_options_header(content_type)
+    boundary = options.get(b"boundary")
+    if mimetype != b"multipart/form-data" or not boundary:
+        raise UploadError(400, "需要 multipart/form-data")
+
+    part = _ImagePart(store.tmp_dir, max_size)
+    callbacks = {
+        name: getattr(part, name)
+        for name in (
+            "on_part_begin", "on_header_field", "on_header_value", "on_header_end",
+            "on_headers_finished", "on_part_data", "on_part_end",
+        )
+    }
+    parser = MultipartParser(boundary, callbacks)
+    try:
+        async for chunk in stream:
+            parser.write(chunk)
+            await part.flush()
+        parser.finalize()
+        if not part.found or part.size == 0:
+            raise UploadError(400, "没有收到图片")
+        if part.ext is None:
+            # 不足 12 字节的“图片”
+            raise UploadError(400, "仅支持 jpg/png/gif/webp 图片")
+        await part.flush(force=True)
+        await asyncio.to_thread(_finish, part.file)
+        image_id = await store.add(
+            part.file.name, part.hasher.hexdigest(), part.ext, part.size
+        )
+        part.file = None
+        return image_id
+    finally:
+        if part.file is not None:
+            await asyncio.to_thread(part.discard)
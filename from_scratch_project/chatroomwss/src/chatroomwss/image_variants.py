@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, Optional
+
+# 缩略图 / 中图：第一次被请求时在进程池里生成（解码大图很吃 CPU，不能放在事件循环里），
+# 存在原图旁边 <sha256>.<size>.<ext>，之后直接读文件。
+# 生成时按 EXIF 方向转正，然后不带 EXIF 保存（顺便去掉 GPS 之类的信息）。
+
+logger = logging.getLogger("uvicorn.error")
+
+# 长边像素上限
+VARIANT_SIZES = {"thumb": 256, "medium": 1280}
+IMAGE_WORKERS = int(os.environ.get("CHATROOM_IMAGE_WORKERS", 2))
+
+
+def render_variant(src: str, dest: str, max_side: int):
+    """在子进程里跑：缩放、去 EXIF，写临时文件再 rename"""
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as img:
+        # JPEG 可以在解码时直接按 1/2、1/4、1/8 缩小，省掉大部分解码开销
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side))
+        fmt = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG", ".webp": "WEBP"}[
+            Path(dest).suffix
+        ]
+        if fmt == "JPEG" and img.mode != "RGB":
+            img = img.convert("RGB")
+        tmp = f"{dest}.{os.getpid()}.tmp"
+        # 不传 exif=，保存出来就不带 EXIF
+        img.save(tmp, fmt, quality=82)
+    os.replace(tmp, dest)
+
+
+class VariantCache:
+    def __init__(self, store, workers: int = IMAGE_WORKERS):
+        self.store = store
+        self.workers = workers
+        self._pool = None
+        # 同一个变体同时被请求多次时只生成一次
+        self._inflight: Dict[Path, asyncio.Future] = {}
+        self._tasks = set()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # uvicorn 进程里有线程，fork 不安全，用 spawn
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def variant_path(self, original: Path, size: str) -> Optional[Path]:
+        """GIF 动图和还没迁移进仓库的老文件不做变体，返回 None"""
+        if original.suffix == ".gif" or original.parent == self.store.root:
+            return None
+        return original.with_name(f"{original.stem}.{size}{original.suffix}")
+
+    async def get(self, original: Path, size: str) -> Path:
+        """返回 size 对应的文件；生成失败就退回原图"""
+        dest = self.variant_path(original, size)
+        if dest is None or dest.exists():
+            return dest or original
+
+        future = self._inflight.get(dest)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self._executor(), render_variant,
+                str(original), str(dest), VARIANT_SIZES[size],
+            )
+            self._inflight[dest] = future
+            future.add_done_callback(lambda _: self._inflight.pop(dest, None))
+        try:
+            await asyncio.shield(future)
+        except BrokenProcessPool as e:
+            # 子进程被杀（比如 OOM）之后整个池都不能用了，下次重建
+            self._pool = None
+            logger.warning("image worker pool broke while rendering %s: %s", original.name, e)
+            return original
+        except Exception as e:
+            logger.warning("failed to render %s variant of %s: %s", size, original.name, e)
+            return original
+        return dest
+
+    def close(self):
+        """停掉进程池；HTTP 服务退出（或 reload）时调用，不留下孤儿进程"""
+        for task in self._tasks:
+            task.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def prefetch(self, original: Path, size: str = "thumb"):
+        """上传完顺手把缩略图生成好，聊天列表马上就要用"""
+        task = asyncio.create_task(self.get(original, size))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,171 @@
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+# 轻量指标：计数器、仪表盘、对数-线性分桶的延迟直方图（HDR 风格，相对误差 ≤ 25%）。
+# 都是在事件循环里单线程更新，不加锁；/xbzchat/v1/metrics 按 Prometheus 文本格式输出。
+
+
+def _log_linear_bounds(lowest: float, highest: float, sub_buckets: int) -> List[float]:
+    bounds = []
+    base = lowest
+    while base < highest:
+        for k in range(sub_buckets):
+            bounds.append(base * (1 + k / sub_buckets))
+        base *= 2
+    bounds.append(base)
+    return bounds
+
+
+# 8µs ~ 64s，每个 2 倍区间切 4 份
+LATENCY_BOUNDS = _log_linear_bounds(2**-17, 64.0, 4)
+
+
+def _label_str(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{v}"' for k, v in labels)
+    return "{" + inner + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_label_str(key)} {value}")
+        return lines
+
+
+class Gauge:
+    """值由回调函数在抓取时现算，例如在线人数、队列长度。
+
+    func 返回 dict 时按 label 展开成多行（比如 FanoutEngine.stats）；
+    kind="counter" 用于各组件自己维护的单调计数。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        func: Callable[[], object],
+        kind: str = "gauge",
+        label: str = "",
+    ):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+        self.label = label
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.func()
+        if isinstance(value, dict):
+            for key, sub in value.items():
+                lines.append(f'{self.name}{{{self.label}="{key}"}} {sub}')
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class _HistogramChild:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, bounds: List[float] = LATENCY_BOUNDS):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        self.children: Dict[tuple, _HistogramChild] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = _HistogramChild(len(self.bounds) + 1)
+        child.counts[bisect.bisect_left(self.bounds, value)] += 1
+        child.sum += value
+        child.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds, child.counts):
+                cumulative += count
+                le = _label_str(key + (("le", f"{bound:.6g}"),))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _label_str(key + (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{le} {child.count}")
+            lines.append(f"{self.name}_sum{_label_str(key)} {child.sum}")
+            lines.append(f"{self.name}_count{_label_str(key)} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help))
+
+    def gauge(self, name: str, help: str, func: Callable[[], object], **kwargs) -> Gauge:
+        # 回调指向具体的实例，重复注册时用新的覆盖
+        gauge = self.metrics[name] = Gauge(name, help, func, **kwargs)
+        return gauge
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "chat_stage_seconds",
+    "Latency of chat handler stages (handshake, db_write, history_load, broadcast, push)",
+)
+MESSAGES_TOTAL = REGISTRY.counter(
+    "chat_messages_total", "Frames broadcast by the chat server, by type"
+)
+RESUME_TOTAL = REGISTRY.counter(
+    "chat_resume_total", "Reconnects with a resume token, by where the missed messages came from"
+)
+THROTTLED_TOTAL = REGISTRY.counter(
+    "chat_throttled_total", "Inbound chat messages held back by rate limits, by scope and action"
+)
+SHED_TOTAL = REGISTRY.counter(
+    "chat_shed_total", "Low-priority frames delayed or refused while overloaded, by frame"
+)
+DB_ROWS_TOTAL = REGISTRY.counter(
+    "chat_db_rows_written_total", "Rows committed by the batched DB writer"
+)
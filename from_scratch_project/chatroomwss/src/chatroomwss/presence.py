@@ -0,0 +1,89 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# 在线状态。以前每次有人进出都给所有人发一遍完整在线列表，N 个人同时重连就是 N² 帧；
+# 现在把一个窗口内的进出攒起来，和上次发出去的列表比一下，只发变化：
+#   {"type": "presence_delta", "version": 8, "added": [...], "removed": [...]}
+# 完整列表 {"type": "online_users", "version": 7, "users": [...]} 只在两种情况下单独发：
+#   - 刚连上；
+#   - 客户端发现 version 不连续（中间的帧被慢连接策略丢了），发 {"type": "presence_sync"}。
+# 客户端只接受 version == 当前 + 1 的 delta，更旧的忽略，跳号就要快照。
+# 同名用户被踢后马上重新登录，一出一进在同一个窗口里抵消，什么都不发。
+
+PRESENCE_DEBOUNCE = float(os.environ.get("CHATROOM_PRESENCE_DEBOUNCE", "0.1"))
+# 过载时在线列表再多等这么久，先让聊天消息过去
+OVERLOAD_DEBOUNCE = float(os.environ.get("CHATROOM_PRESENCE_OVERLOAD_DEBOUNCE", "1.0"))
+
+Snapshot = Callable[[], Awaitable[List[str]]]
+Publish = Callable[[int, List[str], List[str]], None]
+
+
+class Presence:
+    """snapshot() 取当前在线用户；publish(version, added, removed) 把 delta 发给所有连接；
+    announce() 在本 worker 的用户有变化时调用（集群模式下同步给其他 worker）"""
+
+    def __init__(
+        self,
+        snapshot: Snapshot,
+        publish: Publish,
+        announce: Optional[Callable[[], Awaitable[None]]] = None,
+        debounce: float = PRESENCE_DEBOUNCE,
+        overloaded: Optional[Callable[[], bool]] = None,
+    ):
+        self.snapshot = snapshot
+        self.publish = publish
+        self.announce = announce
+        self.debounce = debounce
+        self.overloaded = overloaded
+        self.version = 0
+        # 最近一次发出去的在线列表（dict 保持顺序），快照就发这个
+        self.members: Dict[str, None] = {}
+        self.stats = {"delta": 0, "suppressed": 0, "snapshot": 0, "deferred": 0}
+        self._local_changed = False
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def users(self) -> List[str]:
+        return list(self.members)
+
+    def changed(self, local: bool = True):
+        """有人进出；窗口内调用多少次都只发一次"""
+        self._local_changed = self._local_changed or local
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.debounce)
+        if self.overloaded is not None and self.overloaded():
+            self.stats["deferred"] += 1
+            await asyncio.sleep(OVERLOAD_DEBOUNCE)
+        # 先清掉，flush 过程中再有变化会排下一个窗口
+        self._task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if self._local_changed and self.announce is not None:
+                self._local_changed = False
+                await self.announce()
+            current = dict.fromkeys(await self.snapshot())
+            added = [user for user in current if user not in self.members]
+            removed = [user for user in self.members if user not in current]
+            if not added and not removed:
+                self.stats["suppressed"] += 1
+                return
+            self.version += 1
+            self.members = current
+            self.stats["delta"] += 1
+            self.publish(self.version, added, removed)
+
+    async def ensure(self, nickname: str):
+        """nickname 发言前先让客户端知道他在线（二进制帧里的 nick_id 要先在在线列表里定义）"""
+        if nickname not in self.members:
+            await self.flush()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
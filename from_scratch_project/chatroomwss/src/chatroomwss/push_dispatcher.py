@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import aiosqlite
+from pywebpush import webpush, WebPushException
+
+from db import connect
+from push_config import VAPID_PRIVATE_KEY, VAPID_CLAIMS
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger("websockets")
+
+# 这些状态码说明订阅已经失效，直接删掉
+_GONE_STATUS = {404, 410}
+# 这些值得稍后重试
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class PushDispatcher:
+    """离线推送：有界队列 + 线程池发送，pywebpush 的同步 HTTP 请求不再卡住事件循环"""
+
+    def __init__(
+        self,
+        db_path: str,
+        db_writer,
+        max_pending: int = 1000,
+        workers: int = 4,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+    ):
+        self.db_path = db_path
+        self.db_writer = db_writer
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="webpush"
+        )
+        self._db: Optional[aiosqlite.Connection] = None
+        self._tasks: List[asyncio.Task] = []
+        # nick_name -> (version, [subscription, ...])
+        self._subs: Dict[str, Tuple[int, list]] = {}
+        self.stats = {
+            "queued": 0,
+            "dropped": 0,
+            "sent": 0,
+            "retried": 0,
+            "failed": 0,
+            "pruned": 0,
+        }
+
+    async def start(self):
+        self._db = await connect(self.db_path)
+        self._tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    def notify(self, nickname: str, title: str, body: str) -> None:
+        """只入队，不等待；队列满了就丢弃（推送本来就是尽力而为）"""
+        try:
+            self._queue.put_nowait((nickname, title, body))
+            self.stats["queued"] += 1
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.warning("Push queue full, dropping notification for %s", nickname)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def invalidate(self, nickname: Optional[str] = None) -> None:
+        if nickname is None:
+            self._subs.clear()
+        else:
+            self._subs.pop(nickname, None)
+
+    async def _subscriptions(self, nickname: str) -> list:
+        # /push/subscribe 在 HTTP 进程里，每次订阅都会把 push_subscription_versions
+        # 里对应用户的 version +1；版本没变就直接用缓存
+        async with self._db.execute(
+            "SELECT version FROM push_subscription_versions WHERE nick_name = ?",
+            (nickname,),
+        ) as cursor:
+            row = await cursor.fetchone()
+        version = row[0] if row else 0
+        cached = self._subs.get(nickname)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        async with self._db.execute(
+            "SELECT endpoint, p256dh, auth FROM push_subscriptions WHERE nick_name = ?",
+            (nickname,),
+        ) as cursor:
+            rows = await cursor.fetchall()
+        subs = [
+            {"endpoint": ep, "keys": {"p256dh": p256dh, "auth": auth}}
+            for ep, p256dh, auth in rows
+        ]
+        self._subs[nickname] = (version, subs)
+        return subs
+
+    async def _worker(self):
+        while True:
+            nickname, title, body = await self._queue.get()
+            try:
+                subs = await self._subscriptions(nickname)
+                data = json.dumps({"title": title, "body": body, "url": "/"})
+                for sub in subs:
+                    if sub["endpoint"].startswith("https://web.push.apple.com/"):
+                        logger.info("Skipping Apple Push for now (requires APNS key)")
+                        continue
+                    await self._deliver(nickname, sub, data)
+            except Exception as e:
+                logger.warning("Push to %s failed: %s", nickname, e)
+
+    async def _deliver(self, nickname: str, sub: dict, data: str):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            try:
+                with STAGE_SECONDS.time(stage="push"):
+                    await loop.run_in_executor(self._pool, self._send_sync, sub, data)
+                self.stats["sent"] += 1
+                return
+            except WebPushException as e:
+                status = e.response.status_code if e.response is not None else None
+                if status in _GONE_STATUS:
+                    await self._prune(nickname, sub["endpoint"])
+                    return
+                if status is not None and status not in _RETRY_STATUS:
+                    self.stats["failed"] += 1
+                    logger.warning("Push failed: %s", e)
+                    return
+                error = e
+            except Exception as e:
+                # 网络错误之类，重试
+                error = e
+            if attempt < self.max_retries:
+                self.stats["retried"] += 1
+                await asyncio.sleep(self.backoff * (2**attempt))
+        self.stats["failed"] += 1
+        logger.warning("Push failed after %d retries: %s", self.max_retries, error)
+
+    @staticmethod
+    def _send_sync(sub: dict, data: str):
+        webpush(
+            subscription_info=sub,
+            data=data,
+            vapid_private_key=VAPID_PRIVATE_KEY,
+            vapid_claims=VAPID_CLAIMS,
+            timeout=10,
+        )
+
+    async def _prune(self, nickname: str, endpoint: str):
+        self.stats["pruned"] += 1
+        logger.info("Pruning expired push subscription for %s", nickname)
+        await self.db_writer.submit(
+            "DELETE FROM push_subscriptions WHERE nick_name = ? AND endpoint = ?",
+            (nickname, endpoint),
+            wait=True,
+        )
+        self.invalidate(nickname)
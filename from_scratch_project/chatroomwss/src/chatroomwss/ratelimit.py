@@ -0,0 +1,120 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# 入站限流和过载判断。
+# 每条聊天消息都要一次 DB 提交 + 一次 N 路广播，一个刷屏的标签页就能把事件循环占满，所以：
+# - 每个连接一个令牌桶，每个昵称再一个（多开标签页、断线重连都算在同一个人头上）；
+# - 超速不多时 handler 先睡一会儿：睡的时候不读 socket，websockets 的入站队列（max_queue）
+#   满了以后 TCP 窗口关上，客户端自然就慢下来了；超得太多就直接丢掉并告诉客户端；
+# - LoadMonitor 看事件循环的延迟，过载时先牺牲低优先级的帧（ping、在线列表、翻页），
+#   聊天消息最后才受影响。
+# rate <= 0 表示不限。
+
+MESSAGE_RATE = float(os.environ.get("CHATROOM_MESSAGE_RATE", "5"))
+MESSAGE_BURST = float(os.environ.get("CHATROOM_MESSAGE_BURST", "20"))
+NICK_RATE = float(os.environ.get("CHATROOM_NICK_RATE", "10"))
+NICK_BURST = float(os.environ.get("CHATROOM_NICK_BURST", "40"))
+# 超速时最多让 handler 等这么久，再久就丢
+MAX_THROTTLE_DELAY = float(os.environ.get("CHATROOM_MAX_THROTTLE_DELAY", "1.0"))
+# 事件循环延迟超过这个值（秒）算过载
+OVERLOAD_LAG = float(os.environ.get("CHATROOM_OVERLOAD_LAG", "0.05"))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: Optional[float] = None) -> float:
+        """还要等多久才有一个令牌；0 表示现在就有"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class NickBuckets:
+    """昵称 -> 令牌桶；只保留最近活跃的 max_size 个，断线重连拿到的还是同一个桶"""
+
+    def __init__(self, rate: float, burst: float, max_size: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def get(self, nickname: str) -> TokenBucket:
+        bucket = self._buckets.get(nickname)
+        if bucket is None:
+            bucket = self._buckets[nickname] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(nickname)
+        return bucket
+
+
+async def throttle(*buckets: TokenBucket, max_delay: float = MAX_THROTTLE_DELAY):
+    """所有桶都有令牌就各扣一个，返回 (放行?, 等了多久, 被哪个桶限住)。
+
+    要等的时间不超过 max_delay 就原地睡到有令牌为止，否则不扣令牌、直接拒绝。
+    """
+    waited, limited_by = 0.0, None
+    while True:
+        delay, blocker = 0.0, None
+        for index, bucket in enumerate(buckets):
+            wait = bucket.wait_time()
+            if wait > delay:
+                delay, blocker = wait, index
+        if blocker is None:
+            for bucket in buckets:
+                bucket.take()
+            return True, waited, limited_by
+        limited_by = blocker
+        if waited + delay > max_delay:
+            return False, waited, blocker
+        await asyncio.sleep(delay)
+        waited += delay
+
+
+class LoadMonitor:
+    """每隔 interval 秒醒一次，醒晚了多少就是事件循环的延迟"""
+
+    def __init__(self, lag_threshold: float = OVERLOAD_LAG, interval: float = 0.1):
+        self.lag_threshold = lag_threshold
+        self.interval = interval
+        self.lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def overloaded(self) -> bool:
+        return self.lag > self.lag_threshold
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - start - self.interval
+            # 平滑一下，单次抖动不算过载
+            self.lag = self.lag * 0.7 + max(lag, 0.0) * 0.3
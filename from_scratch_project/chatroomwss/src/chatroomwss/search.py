@@ -0,0 +1,163 @@
+import html
+from typing import Awaitable, Callable, List, Optional
+
+# 聊天记录全文搜索，索引是 db.MIGRATIONS 第 2 版建的 message_fts（trigram 分词）。
+# - 搜索词按空白拆开，每个词都要出现（AND），词内按子串匹配，不区分大小写；
+# - trigram 至少要 3 个字符才能走索引，短词（比如"火锅"）在索引命中的行上再用 LIKE 过滤；
+#   全是短词时只能按 id 从新到旧扫 message_history：凑够一页就停，但一次最多扫 SCAN_WINDOW 行，
+#   扫完还不够一页也先返回（可能是空页），has_more 为真时客户端接着翻；
+# - 和历史翻页一样按 id 做 keyset：结果从新到旧，下一页把 next_before_id 传回来；
+# - 消息入库前做过 HTML 转义，搜索词也转义一遍再匹配；snippet 里只有 <mark> 是标签。
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MAX_TERMS = 8
+# 不走索引时一次请求最多扫多少行（100 万行全扫大约 300ms）
+SCAN_WINDOW = 100_000
+# snippet 的长度（trigram 下差不多就是字符数）
+SNIPPET_TOKENS = 24
+MARK_OPEN = "<mark>"
+MARK_CLOSE = "</mark>"
+# 老数据里的系统消息不参与搜索
+_NOT_SYSTEM = "h.message NOT LIKE '%has entered%' AND h.message NOT LIKE '%has left%'"
+
+
+def clamp_search_limit(limit) -> int:
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_SEARCH_LIMIT
+    return max(1, min(limit, MAX_SEARCH_LIMIT))
+
+
+def parse_terms(q) -> List[str]:
+    """搜索串 -> 转义过的词列表；没有可搜的内容时抛 ValueError"""
+    if not isinstance(q, str):
+        raise ValueError("empty search query")
+    terms = [html.escape(term) for term in q.split()][:MAX_TERMS]
+    if not terms:
+        raise ValueError("empty search query")
+    return terms
+
+
+def _phrase(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def uses_index(terms: List[str]) -> bool:
+    return any(len(term) >= 3 for term in terms)
+
+
+def search_query(
+    terms: List[str],
+    before_id: Optional[int],
+    limit: int,
+    nickname: Optional[str] = None,
+    floor: Optional[int] = None,
+):
+    """返回 (sql, params)；结果行是 (id, nick_name, message, time_stamp, snippet)，
+    多取一行用来判断还有没有更早的结果。floor 是不走索引时这次扫描的下界（含）"""
+    indexed = [term for term in terms if len(term) >= 3]
+    where = []
+    params = []
+    if indexed:
+        sql = (
+            "SELECT h.id, h.nick_name, h.message, h.time_stamp, "
+            f"snippet(message_fts, 0, '{MARK_OPEN}', '{MARK_CLOSE}', '…', {SNIPPET_TOKENS}) "
+            "FROM message_fts JOIN message_history h ON h.id = message_fts.rowid"
+        )
+        where.append("message_fts MATCH ?")
+        params.append(" AND ".join(_phrase(term) for term in indexed))
+        order_by = "message_fts.rowid"
+    else:
+        sql = "SELECT h.id, h.nick_name, h.message, h.time_stamp, NULL FROM message_history h"
+        order_by = "h.id"
+    if before_id is not None:
+        where.append(f"{order_by} < ?")
+        params.append(int(before_id))
+    if floor is not None:
+        where.append(f"{order_by} >= ?")
+        params.append(floor)
+    for term in terms:
+        if len(term) < 3:
+            where.append("h.message LIKE ? ESCAPE '\\'")
+            params.append(_like_pattern(term))
+    if nickname:
+        where.append("h.nick_name = ?")
+        params.append(nickname)
+    where.append(_NOT_SYSTEM)
+    sql += " WHERE " + " AND ".join(where) + f" ORDER BY {order_by} DESC LIMIT ?"
+    params.append(limit + 1)
+    return sql, tuple(params)
+
+
+def make_snippet(message: str, terms: List[str], width: int = SNIPPET_TOKENS) -> str:
+    """没走索引时（全是短词）自己截一段：第一个命中的词前后各留一点，命中处加 <mark>"""
+    text = html.unescape(message)
+    lowered = text.lower()
+    for term in terms:
+        term = html.unescape(term)
+        start = lowered.find(term.lower())
+        if start < 0:
+            continue
+        end = start + len(term)
+        left = max(0, start - (width - len(term)) // 2)
+        right = min(len(text), left + max(width, len(term)))
+        return (
+            ("…" if left > 0 else "")
+            + html.escape(text[left:start])
+            + MARK_OPEN + html.escape(text[start:end]) + MARK_CLOSE
+            + html.escape(text[end:right])
+            + ("…" if right < len(text) else "")
+        )
+    return message
+
+
+def build_results(rows, limit: int, terms: List[str], floor: Optional[int] = None) -> dict:
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_before_id = rows[-1][0] if has_more else None
+    if not has_more and floor:
+        # 这一段扫完了，从下界往前接着扫
+        has_more, next_before_id = True, floor
+    results = [
+        {
+            "id": msg_id,
+            "nickname": nick,
+            "content": msg,
+            "timestamp": ts,
+            "snippet": snippet if snippet is not None else make_snippet(msg, terms),
+        }
+        for msg_id, nick, msg, ts, snippet in rows
+    ]
+    return {
+        "results": results,
+        "next_before_id": next_before_id,
+        "has_more": has_more,
+    }
+
+
+async def run_search(
+    fetchall: Callable[[str, tuple], Awaitable[list]],
+    q,
+    before_id: Optional[int] = None,
+    limit=DEFAULT_SEARCH_LIMIT,
+    nickname: Optional[str] = None,
+) -> dict:
+    """聊天服务和 HTTP 服务共用；fetchall(sql, params) 由调用方提供。搜索串为空时抛 ValueError"""
+    terms = parse_terms(q)
+    limit = clamp_search_limit(limit)
+    floor = None
+    if not uses_index(terms):
+        if before_id is None:
+            rows = await fetchall("SELECT MAX(id) FROM message_history", ())
+            before_id = (rows[0][0] or 0) + 1
+        floor = max(0, before_id - SCAN_WINDOW)
+    sql, params = search_query(terms, before_id, limit, nickname, floor)
+    rows = await fetchall(sql, params)
+    return build_results(rows, limit, terms, floor)
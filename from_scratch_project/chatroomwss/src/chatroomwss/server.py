@@ -5,15 +5,51 @@ from websockets.asyncio.server import serve
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosed
 from asyncio import Lock
 import logging
+import os
+import random
 import secrets
+import socket
+import time
+from http import HTTPStatus
 from datetime import datetime
-import sqlite3
 from html import escape
-from typing import Dict, Tuple
-import aiosqlite
+from typing import Dict, List, Tuple
 import json
-from pywebpush import webpush, WebPushException
-from push_config import VAPID_PRIVATE_KEY, VAPID_CLAIMS
+import db
+import wire
+from db_writer import BatchedDBWriter
+from fanout import FanoutEngine
+from history_cache import HistoryCache
+from push_dispatcher import PushDispatcher
+from metrics import (
+    MESSAGES_TOTAL,
+    REGISTRY,
+    RESUME_TOTAL,
+    SHED_TOTAL,
+    STAGE_SECONDS,
+    THROTTLED_TOTAL,
+)
+from history_page import (
+    DEFAULT_PAGE_SIZE,
+    MAX_RESUME_MESSAGES,
+    build_page,
+    build_resume,
+    clamp_page_size,
+    page_query,
+    resume_query,
+)
+from presence import Presence
+from search import run_search
+from ratelimit import (
+    MESSAGE_BURST,
+    MESSAGE_RATE,
+    NICK_BURST,
+    NICK_RATE,
+    LoadMonitor,
+    NickBuckets,
+    TokenBucket,
+    throttle,
+)
 
 logging.basicConfig(
     format="%(asctime)s %(message)s",
@@ -24,12 +60,37 @@ logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 VALID_USERS = {"tom", "香啵猪"}
+METRICS_PATH = "/xbzchat/v1/metrics"
+
+# 进出聊天室这类每个连接都会打的日志：full 全打，sampled 按比例抽样，off 不打
+LOG_MODE = os.environ.get("CHATROOM_LOG_MODE", "full")
+LOG_SAMPLE_RATE = float(os.environ.get("CHATROOM_LOG_SAMPLE_RATE", "0.01"))
+
+
+def _log_event(msg, *args):
+    # 参数延迟格式化：被过滤掉的日志不会拼字符串
+    if LOG_MODE == "off":
+        return
+    if LOG_MODE == "sampled" and random.random() >= LOG_SAMPLE_RATE:
+        return
+    logger.info(msg, *args)
 
 
 def _now():
     return datetime.now().__str__()[:23]
 
 
+# 进出提示里最多列出几个昵称，一次进出很多人时只报个数
+MAX_NOTICE_NAMES = 10
+
+
+def _presence_notice(users: list, verb: str) -> str:
+    names = ", ".join(users[:MAX_NOTICE_NAMES])
+    if len(users) > MAX_NOTICE_NAMES:
+        names += f" and {len(users) - MAX_NOTICE_NAMES} others"
+    return f"{names} {'has' if len(users) == 1 else 'have'} {verb} the chat"
+
+
 def sanitize_input(text: str) -> str:
     """防止 XSS：转义 HTML 特殊字符"""
     if not isinstance(text, str):
@@ -38,34 +99,34 @@ def sanitize_input(text: str) -> str:
 
 
 async def _init_db():
-    async with aiosqlite.connect("chat.db") as db:
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users_status (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                join_key TEXT NOT NULL,
-                nick_name TEXT NOT NULL,
-                status TEXT NOT NULL,
-                time_stamp TEXT NOT NULL
-            )
-        """
-        )
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS message_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                join_key TEXT NOT NULL,
-                nick_name TEXT NOT NULL,
-                message TEXT NOT NULL,
-                time_stamp TEXT NOT NULL
-            )
-        """
-        )
-        await db.commit()
+    # 建表和升级都在 db.MIGRATIONS 里，HTTP 服务启动时也会执行同一套
+    await db.init_db()
 
 
 class MyWebSS:
-    def __init__(self, host, port):
+    def __init__(
+        self,
+        host,
+        port,
+        db_flush_size=100,
+        db_flush_interval=0.05,
+        send_queue_size=256,
+        slow_consumer_policy="coalesce",
+        history_size=50,
+        history_page_size=DEFAULT_PAGE_SIZE,
+        resume_limit=MAX_RESUME_MESSAGES,
+        push_workers=4,
+        push_queue_size=1000,
+        bus=None,
+        reuse_port=False,
+        message_rate=MESSAGE_RATE,
+        message_burst=MESSAGE_BURST,
+        nick_rate=NICK_RATE,
+        nick_burst=NICK_BURST,
+        max_frame_size=64 * 1024,
+        max_inbound_queue=8,
+        overload_db_backlog=5000,
+    ):
         self.host = host
         self.port = port
         self.clients_lock = Lock()
@@ -74,154 +135,456 @@ class MyWebSS:
         self.clients: Dict[str, Tuple[asyncio.StreamWriter, str]] = {}
         self.nick_to_key: Dict[str, str] = {}
         self.db_lock = Lock()
-        self.conn = sqlite3.connect("chat.db")
-        self.cursor = self.conn.cursor()
         self._shutdown = asyncio.Event()
-        self.db_path = "chat.db"
+        self.db_path = db.DB_PATH
+        # 长连接 + 批量提交，消息和上下线记录都走这里
+        self.db_writer = BatchedDBWriter(
+            self.db_path, flush_size=db_flush_size, flush_interval=db_flush_interval
+        )
+        # 广播不再持锁逐个 await send，慢连接的处理策略见 fanout.py
+        self.fanout = FanoutEngine(
+            max_queue=send_queue_size, policy=slow_consumer_policy
+        )
+        # 最近 history_size 条消息常驻内存，重连不查库
+        self.history_cache = HistoryCache(history_size)
+        self.history_page_size = clamp_page_size(history_page_size)
+        # 重连时最多补发多少条，超过就让客户端重新同步
+        self.resume_limit = resume_limit
+        self.read_db = None
+        # 离线推送放到独立的队列和线程池里，不占用聊天的事件循环
+        self.push = PushDispatcher(
+            self.db_path,
+            self.db_writer,
+            max_pending=push_queue_size,
+            workers=push_workers,
+        )
+        # 集群模式：多个 worker 通过 bus 同步广播、在线列表和踢人（见 cluster.py）
+        self.bus = bus
+        self.reuse_port = reuse_port
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(2)}"
+        # worker_id -> 该 worker 上的在线昵称
+        self.remote_users: Dict[str, List[str]] = {}
+        # 协商了二进制子协议的连接（见 wire.py），以及二进制帧里用的昵称编号
+        self.binary_keys = set()
+        self.nicks = wire.NickTable()
+        # 入站限流：每个连接一个令牌桶，每个昵称一个（见 ratelimit.py）
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.nick_buckets = NickBuckets(nick_rate, nick_burst)
+        # 单帧上限和每个连接缓冲的入站帧数；handler 处理不过来时靠它把压力推回客户端
+        self.max_frame_size = max_frame_size
+        self.max_inbound_queue = max_inbound_queue
+        self.load = LoadMonitor()
+        self.overload_db_backlog = overload_db_backlog
+        # 进出聊天室攒一个窗口再发 presence_delta，见 presence.py
+        self.presence = Presence(
+            self.get_online_users,
+            self._publish_presence_delta,
+            announce=self._announce_presence if bus is not None else None,
+            overloaded=self.overloaded,
+        )
+
+        REGISTRY.gauge(
+            "chat_connected_clients",
+            "WebSocket clients connected to this worker",
+            lambda: len(self.clients),
+        )
+        REGISTRY.gauge(
+            "chat_fanout_frames_total",
+            "Outbound frames by fan-out result",
+            lambda: self.fanout.stats,
+            kind="counter",
+            label="result",
+        )
+        REGISTRY.gauge(
+            "chat_db_write_queue_depth",
+            "Rows waiting in the batched DB writer",
+            self.db_writer.pending,
+        )
+        REGISTRY.gauge(
+            "chat_presence_total",
+            "Presence flushes by result",
+            lambda: self.presence.stats,
+            kind="counter",
+            label="result",
+        )
+        REGISTRY.gauge(
+            "chat_event_loop_lag_seconds",
+            "Smoothed event loop lag; above the threshold the worker sheds low-priority frames",
+            lambda: self.load.lag,
+        )
+        REGISTRY.gauge(
+            "chat_push_total",
+            "Web Push notifications by result",
+            lambda: self.push.stats,
+            kind="counter",
+            label="result",
+        )
+        REGISTRY.gauge(
+            "chat_push_queue_depth",
+            "Notifications waiting for a push worker",
+            self.push.pending,
+        )
 
     async def start_server(self):
-        async with serve(self.handler, self.host, self.port) as server:
-            await server.serve_forever()
-
-    async def save_message_to_DB(self, join_key, nickname, message, time_stamp):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "INSERT INTO message_history (join_key, nick_name, message, time_stamp) VALUES (?, ?, ?, ?)",
-                (join_key, nickname, message, time_stamp),
-            )
-            await db.commit()
+        await self.history_cache.warm(self.db_path)
+        await self.db_writer.start()
+        # 翻页查询用的只读长连接（WAL 下不会和写连接互相阻塞）
+        self.read_db = await db.connect(self.db_path)
+        await self.push.start()
+        self.load.start()
+        if self.bus is not None:
+            await self.bus.start(self.worker_id, self._on_bus_message)
+            await self.bus.publish({"kind": "hello"})
+        serve_kwargs = {"reuse_port": True} if self.reuse_port else {}
+        try:
+            async with serve(
+                self.handler,
+                self.host,
+                self.port,
+                process_request=self._process_request,
+                select_subprotocol=wire.select_subprotocol,
+                max_size=self.max_frame_size,
+                max_queue=self.max_inbound_queue,
+                **serve_kwargs,
+            ) as server:
+                await server.serve_forever()
+        finally:
+            self.presence.close()
+            self.load.close()
+            if self.bus is not None:
+                await self.bus.close()
+            await self.push.close()
+            await self.read_db.close()
+            await self.db_writer.close()
+
+    def _process_request(self, connection, request):
+        # 普通 HTTP 请求：/xbzchat/v1/metrics 直接返回指标，其他路径照常握手
+        if request.path == METRICS_PATH:
+            response = connection.respond(HTTPStatus.OK, REGISTRY.render())
+            del response.headers["Content-Type"]
+            response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+            return response
+        return None
+
+    async def save_message_to_DB(
+        self, join_key, nickname, message, time_stamp, wait=False
+    ):
+        # wait=True 时等到落盘（commit）后返回 message_history.id
+        return await self.db_writer.submit(
+            "INSERT INTO message_history (join_key, nick_name, message, time_stamp) VALUES (?, ?, ?, ?)",
+            (join_key, nickname, message, time_stamp),
+            wait=wait,
+        )
 
-    async def save_login_status_to_DB(self, status, join_key, nickname, time_stamp):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "INSERT INTO users_status (join_key, nick_name, status, time_stamp) VALUES (?, ?, ?, ?)",
-                (join_key, nickname, status, time_stamp),
-            )
-            await db.commit()
+    async def save_login_status_to_DB(
+        self, status, join_key, nickname, time_stamp, wait=False
+    ):
+        row_id = await self.db_writer.submit(
+            "INSERT INTO users_status (join_key, nick_name, status, time_stamp) VALUES (?, ?, ?, ?)",
+            (join_key, nickname, status, time_stamp),
+            wait=wait,
+        )
+        await self.db_writer.submit(
+            db.UPSERT_LAST_STATUS[status], (nickname, time_stamp)
+        )
+        return row_id
 
     async def load_history(self, websocket):
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT nick_name, message, time_stamp FROM message_history ORDER BY id DESC LIMIT 50"
-            ) as cursor:
-                rows = await cursor.fetchall()
-        # 从旧到新发送
-        for row in reversed(rows):
-            nick, msg, ts = row
-            logging.info(f"{nick} # {msg} # {ts}")
-            if "has entered" in msg or "has left" in msg:
-                continue  # 跳过系统消息
+        # 一帧发完整段历史（从旧到新），编码结果在缓存里复用
+        with STAGE_SECONDS.time(stage="history_load"):
+            await websocket.send(self.history_cache.frame())
+
+    async def resume_history(self, websocket, last_id: int, upto=None):
+        """重连补发 last_id 之后的消息。
+
+        upto 是注册连接时缓冲里最新的 id，更新的消息已经会通过正常广播收到；
+        优先从内存缓冲取，缓冲不够再查库，缺得太多就发 resync + 完整的 history。
+        """
+        with STAGE_SECONDS.time(stage="history_load"):
+            newest = self.history_cache.newest_id()
+            if newest is not None and last_id > newest:
+                # 客户端的 id 比服务端最新的还大（比如库被换过），只能重新同步
+                messages = None
             else:
-                payload = {
-                    "type": "history",
-                    "nickname": nick,
-                    "content": msg,
-                    "timestamp": ts,
-                }
-                await websocket.send(json.dumps(payload))
+                messages = self.history_cache.since(last_id, upto)
+                source = "cache"
+                if messages is None:
+                    sql, params = resume_query(last_id, upto, self.resume_limit)
+                    async with self.read_db.execute(sql, params) as cursor:
+                        rows = await cursor.fetchall()
+                    messages = build_resume(rows, self.resume_limit)
+                    source = "db"
+                elif len(messages) > self.resume_limit:
+                    messages = None
+
+            if messages is None:
+                RESUME_TOTAL.inc(source="resync")
+                await websocket.send(
+                    wire.dumps({"type": "resync", "reason": "gap_too_large"})
+                )
+                await websocket.send(self.history_cache.frame())
+                return
+            RESUME_TOTAL.inc(source=source)
+            await websocket.send(
+                wire.dumps({"type": "resume", "after_id": last_id, "messages": messages})
+            )
 
-    async def get_online_users(self) -> list:
+    def overloaded(self) -> bool:
+        """事件循环延迟太大，或者写库队列积压太多"""
+        return self.load.overloaded or self.db_writer.pending() > self.overload_db_backlog
+
+    async def admit_message(self, websocket, conn_bucket: TokenBucket, nickname: str) -> bool:
+        """聊天消息过限流；超速不多就等一会儿再放行，超太多丢掉并告诉客户端"""
+        allowed, _, blocker = await throttle(
+            conn_bucket, self.nick_buckets.get(nickname)
+        )
+        if blocker is None:
+            return True
+        scope = ("connection", "nickname")[blocker]
+        THROTTLED_TOTAL.inc(scope=scope, action="delayed" if allowed else "dropped")
+        if allowed:
+            return True
+        await websocket.send(
+            wire.dumps({"type": "throttled", "scope": scope, "timestamp": _now()})
+        )
+        return False
+
+    async def send_pong(self, websocket, join_key: str, frame):
+        if self.overloaded():
+            # 过载时 pong 排到发送队列里，不插在聊天消息前面；没发出去的 pong 合并成一个
+            SHED_TOTAL.inc(frame="ping")
+            self.fanout.publish(frame, [join_key], coalesce_key="pong")
+        else:
+            await websocket.send(frame)
+
+    async def _read_fetchall(self, sql, params):
+        async with self.read_db.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    async def load_history_page(self, before_id=None, limit=None, nickname=None):
+        limit = clamp_page_size(limit or self.history_page_size)
+        sql, params = page_query(before_id, limit, nickname)
+        async with self.read_db.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+        return build_page(rows, limit)
+
+    def _publish(self, recipients, text_frame, make_binary, coalesce_key=None):
+        """JSON 连接收 text_frame；二进制连接收 make_binary() 编出的帧，没有就不编"""
+        if not self.binary_keys:
+            self.fanout.publish(text_frame, recipients, coalesce_key)
+            return
+        text_keys, binary_keys = [], []
+        for key in recipients:
+            (binary_keys if key in self.binary_keys else text_keys).append(key)
+        if text_keys:
+            self.fanout.publish(text_frame, text_keys, coalesce_key)
+        if binary_keys:
+            self.fanout.publish(make_binary(), binary_keys, coalesce_key)
+
+    def _binary_event(self, payload: dict) -> bytes:
+        kind = wire.EVENT_KINDS.get(payload["type"], wire.K_SYSTEM)
+        nick_id = wire.NO_NICK
+        if kind == wire.K_MESSAGE:
+            [(nick_id, _)] = self._nick_ids([payload["nickname"]])
+        return wire.encode_event(
+            kind, nick_id, payload.get("id"),
+            wire.timestamp_ms(payload["timestamp"]), payload["content"],
+        )
+
+    async def get_local_users(self) -> list:
         async with self.clients_lock:
             return [nick for _, nick in self.clients.values()]
 
+    async def get_online_users(self) -> list:
+        users = await self.get_local_users()
+        for remote in self.remote_users.values():
+            users.extend(remote)
+        # 跨 worker 踢同名用户的瞬间可能出现重复
+        return list(dict.fromkeys(users))
+
     async def broadcast_online_list(self):
-        online_users = await self.get_online_users()
-        payload = {
-            "type": "online_users",
-            "users": online_users,
-        }
-        message = json.dumps(payload)
-        async with self.clients_lock:
-            for ws, _ in list(self.clients.values()):
-                try:
-                    await ws.send(message)
-                except ConnectionClosed:
-                    pass
-
-    # webpush
-    def load_webpush_subscriptions(self, nickname: str):
-        conn = sqlite3.connect("chat.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-        SELECT endpoint, p256dh, auth
-        FROM push_subscriptions
-        WHERE nick_name = ?
-        """,
-            (nickname,),
+        # 只做标记，窗口结束时统一算差、发 presence_delta
+        self.presence.changed()
+
+    async def _announce_presence(self):
+        await self.bus.publish(
+            {"kind": "presence", "users": await self.get_local_users()}
         )
-        rows = cursor.fetchall()
-        conn.close()
 
-        subs = []
-        for ep, p256dh, auth in rows:
-            subs.append({"endpoint": ep, "keys": {"p256dh": p256dh, "auth": auth}})
-        return subs
+    def _nick_ids(self, users: list) -> list:
+        """编二进制帧前统一取 [(nick_id, nickname)]；编号不够就先重新编号"""
+        if not self.nicks.room(users):
+            self.nicks.reset()
+            self._resend_binary_snapshots()
+        return [(self.nicks.intern(user), user) for user in users]
+
+    def _resend_binary_snapshots(self):
+        # 重新编号后，二进制连接手里的 id 全部作废：排在后面那一帧之前重发完整在线列表。
+        # 不能合并替换，否则会被挪到用旧编号的帧前面
+        if not self.binary_keys:
+            return
+        version, users = self.presence.version, self.presence.users()
+        frame = wire.encode_online(
+            version, [(self.nicks.intern(user), user) for user in users]
+        )
+        self.presence.stats["snapshot"] += len(self.binary_keys)
+        self.fanout.publish(frame, list(self.binary_keys))
 
-    def send_webpush(self, sub, title, body):
-        try:
-            webpush(
-                subscription_info=sub,
-                data=json.dumps({"title": title, "body": body, "url": "/"}),
-                vapid_private_key=VAPID_PRIVATE_KEY,
-                vapid_claims=VAPID_CLAIMS,
-            )
-        except WebPushException as e:
-            logger.warning(f"Push failed: {e}")
+    def _publish_presence_delta(self, version: int, added: list, removed: list):
+        payload = {
+            "type": "presence_delta",
+            "version": version,
+            "added": added,
+            "removed": removed,
+        }
+        recipients = list(self.clients)
+        # delta 不能合并替换，丢了客户端靠 version 跳号发现、再要快照
+        self._publish(
+            recipients,
+            wire.dumps(payload),
+            lambda: self._encode_presence_delta(version, added, removed),
+        )
+        # 进出提示也跟着 delta 走：一个窗口最多一条进、一条出，被同名新连接踢掉的一出一进互相抵消。
+        # 每个 worker 按自己看到的全局差异发给本地连接，不走 bus
+        for users, verb in ((added, "entered"), (removed, "left")):
+            if users:
+                self._publish_system(recipients, _presence_notice(users, verb))
+
+    def _encode_presence_delta(self, version: int, added: list, removed: list) -> bytes:
+        # added 和 removed 一起取 id，中途重新编号也不会一半新一半旧
+        ids = self._nick_ids(added + removed)
+        return wire.encode_presence_delta(version, ids[: len(added)], ids[len(added):])
+
+    def _publish_system(self, recipients, content: str):
+        payload = {
+            "type": "system",
+            "id": None,
+            "nickname": "system",
+            "content": content,
+            "timestamp": _now(),
+        }
+        self._publish(recipients, wire.dumps(payload), lambda: self._binary_event(payload))
+        MESSAGES_TOTAL.inc(type="system")
+
+    def _send_presence_snapshot(self, join_key: str):
+        # 和其他帧走同一个发送队列，保证先于之后的 delta 到达
+        version, users = self.presence.version, self.presence.users()
+        self.presence.stats["snapshot"] += 1
+        # 先取 id（可能触发重新编号），再定合并用的 key：重新编号前后的快照不能互相替换
+        ids = self._nick_ids(users) if join_key in self.binary_keys else []
+        self._publish(
+            [join_key],
+            wire.dumps({"type": "online_users", "version": version, "users": users}),
+            lambda: wire.encode_online(version, ids),
+            coalesce_key=f"online_users:{self.nicks.resets}",
+        )
 
     async def broadcast_message(
-        self, join_key: str, nickname: str, content: str, msg_type: str = "message"
+        self,
+        join_key: str,
+        nickname: str,
+        content: str,
+        msg_type: str = "message",
+        durable: bool = False,
     ):
+        """durable=True 时先等消息 commit 再广播，并返回 message_history.id"""
         time_stamp = _now()
+        message_id = None
         # 保存到 DB（仅普通消息）
         if msg_type == "message":
-            await self.save_message_to_DB(join_key, nickname, content, time_stamp)
+            with STAGE_SECONDS.time(stage="db_write"):
+                message_id = await self.save_message_to_DB(
+                    join_key, nickname, content, time_stamp, wait=durable
+                )
+            self.history_cache.append(nickname, content, time_stamp, message_id)
 
         payload = {
             "type": msg_type,
+            "id": message_id,
             "nickname": nickname,
             "content": content,
             "timestamp": time_stamp,
         }
-        message = json.dumps(payload)
+        if msg_type == "message":
+            await self.presence.ensure(nickname)
+        with STAGE_SECONDS.time(stage="broadcast"):
+            message = wire.dumps(payload)
+            async with self.clients_lock:
+                recipients = list(self.clients)
+            self._publish(recipients, message, lambda: self._binary_event(payload))
+            if self.bus is not None:
+                await self.bus.publish(
+                    {"kind": "broadcast", "msg_type": msg_type, "frame": message}
+                )
+        MESSAGES_TOTAL.inc(type=msg_type)
+
+        # push notification：给不在线的用户发离线推送（只入队，不阻塞）
+        if msg_type == "message":
+            online_users = set(await self.get_online_users())
+            for user in VALID_USERS:
+                if user != nickname and user not in online_users:
+                    self.push.notify(user, title=f"{nickname} 给你发了消息", body=content)
+
+        return message_id
+
+    async def _kick_local(self, nickname: str, keep_join_key: str):
+        # 同名用户在别的 worker 上登录了，踢掉本 worker 上的旧连接
         async with self.clients_lock:
-            for ws, _ in list(self.clients.values()):
-                try:
-                    await ws.send(message)
-                except ConnectionClosed:
-                    pass
-
-        # push notification
-        #if msg_type == "message":
-        #    for user in VALID_USERS:
-        #        logger.info(f"I'm in {nickname}'s push note process, checking {user}")
-        #        if user != nickname and user not in [
-        #            nick for _, nick in self.clients.values()
-        #        ]:  # online_users:
-        #            subs = self.load_webpush_subscriptions(user)
-        #            logger.info(f"{subs} has subscribed")
-        #            for sub in subs:
-        #                try:
-        #                    logger.info(
-        #                        f"Push notification to: {sub} from {nickname}, {content}"
-        #                    )
-        #                    if sub["endpoint"].startswith(
-        #                        "https://web.push.apple.com/"
-        #                    ):
-        #                        logger.info(
-        #                            "Skipping Apple Push for now (requires APNS key)"
-        #                        )
-        #                        continue
-        #                    else:
-        #                        self.send_webpush(
-        #                            sub, title=f"{nickname} 给你发了消息", body=content
-        #                        )
-        #                except Exception as e:
-        #                    logger.info(f" error {e}")
+            old_join_key = self.nick_to_key.get(nickname)
+            if old_join_key in (None, keep_join_key) or old_join_key not in self.clients:
+                return
+            old_ws, _ = self.clients.pop(old_join_key)
+            self.fanout.unregister(old_join_key)
+            self.binary_keys.discard(old_join_key)
+            del self.nick_to_key[nickname]
+        _log_event("Kicking previous connection for nickname: %s", nickname)
+        try:
+            await old_ws.close(code=1000, reason="Reconnected from another device")
+        except Exception as e:
+            logger.debug(f"Error closing old connection: {e}")
+
+    async def _on_bus_message(self, msg: dict):
+        kind = msg.get("kind")
+        worker = msg.get("worker")
+        if kind == "broadcast":
+            frame = msg["frame"]
+            payload = None
+            if msg.get("msg_type") == "message":
+                payload = wire.loads(frame)
+                # 转发来的 id 可能比本地刚写入的小，append 按 id 插入，重连补发才不会漏
+                self.history_cache.append(
+                    payload["nickname"],
+                    payload["content"],
+                    payload["timestamp"],
+                    payload.get("id"),
+                )
+                await self.presence.ensure(payload["nickname"])
+            async with self.clients_lock:
+                recipients = list(self.clients)
+            self._publish(
+                recipients,
+                frame,
+                lambda: self._binary_event(payload or wire.loads(frame)),
+            )
+        elif kind == "presence":
+            self.remote_users[worker] = msg.get("users", [])
+            self.presence.changed(local=False)
+        elif kind == "hello":
+            # 新 worker 上线，把本地在线用户告诉它
+            await self.bus.publish(
+                {"kind": "presence", "users": await self.get_local_users()}
+            )
+        elif kind == "worker_gone":
+            if self.remote_users.pop(worker, None) is not None:
+                self.presence.changed(local=False)
+        elif kind == "kick":
+            await self._kick_local(msg["nickname"], msg["join_key"])
 
     async def handler(self, websocket):
         nickname = "Guest"
         join_key = secrets.token_urlsafe(12)
+        handshake_start = time.perf_counter()
 
         # 发送欢迎信息（纯文本兼容老客户端，但建议前端用 JSON）
         welcome = {
@@ -231,11 +594,20 @@ class MyWebSS:
         await websocket.send(json.dumps(welcome))
         try:
             raw = await websocket.recv()
+            if isinstance(raw, bytes):
+                raw = raw.decode("utf-8", "replace")
             # 尝试解析为 JSON，否则当作纯文本昵称
+            # 断线重连的客户端带上看到的最后一条消息 id：{"nickname": "...", "last_id": 123}
+            last_id = None
             try:
                 data = json.loads(raw)
                 if isinstance(data, dict):
                     input_nick = data.get("nickname", "Guest")
+                    try:
+                        last_id = data.get("last_id")
+                        last_id = int(last_id) if last_id is not None else None
+                    except (TypeError, ValueError):
+                        last_id = None
                 else:
                     input_nick = str(data)
             except json.JSONDecodeError:
@@ -244,6 +616,7 @@ class MyWebSS:
 
             # 防止全空白或超长昵称
             nickname = nickname[:20]
+            conn_bucket = TokenBucket(self.message_rate, self.message_burst)
 
             # === 新增逻辑：踢掉同名旧用户 ===
             async with self.clients_lock:
@@ -251,8 +624,8 @@ class MyWebSS:
                     old_join_key = self.nick_to_key[nickname]
                     if old_join_key in self.clients:
                         old_ws, _ = self.clients[old_join_key]
-                        logger.info(
-                            f"Kicking previous connection for nickname: {nickname}"
+                        _log_event(
+                            "Kicking previous connection for nickname: %s", nickname
                         )
                         try:
                             await old_ws.close(
@@ -262,52 +635,131 @@ class MyWebSS:
                             logger.debug(f"Error closing old connection: {e}")
                         # 清理旧记录（注意：不要在这里发广播，等 finally 统一处理）
                         del self.clients[old_join_key]
+                        self.fanout.unregister(old_join_key)
+                        self.binary_keys.discard(old_join_key)
                         # 注意：不立即 del self.nick_to_key[nickname]，因为下面会覆盖
 
                 # 注册新用户
                 self.clients[join_key] = (websocket, nickname)
                 self.nick_to_key[nickname] = join_key
-                logger.info(f"{nickname} has joined the chat")
+                self.fanout.register(join_key, websocket)
+                if websocket.subprotocol == wire.SUBPROTOCOL_BINARY:
+                    self.binary_keys.add(join_key)
+                # 从这里开始的新消息都会广播给这个连接，补发只补到这一条
+                resume_upto = self.history_cache.newest_id()
+
+            if self.bus is not None:
+                await self.bus.publish(
+                    {"kind": "kick", "nickname": nickname, "join_key": join_key}
+                )
 
             await self.save_login_status_to_DB("login", join_key, nickname, _now())
-            logger.info(f"{nickname} has joined the chat")
+            _log_event("%s has joined the chat", nickname)
 
-            # 发送历史消息
-            await self.load_history(websocket)
+            # 发送历史消息；带了 last_id 的只补发缺的
+            if last_id is None:
+                await self.load_history(websocket)
+            else:
+                await self.resume_history(websocket, last_id, resume_upto)
+            STAGE_SECONDS.observe(time.perf_counter() - handshake_start, stage="handshake")
 
-            # 广播加入消息 & 更新在线列表
-            await self.broadcast_message(
-                join_key, nickname, f"{nickname} has entered the chat", "system"
-            )
+            # 新连接先拿一份在线列表快照；加入提示和其他人的 presence_delta 一起发
+            self._send_presence_snapshot(join_key)
             await self.broadcast_online_list()
 
             # 主消息循环
             while True:
                 raw = await websocket.recv()
 
+                if isinstance(raw, bytes):
+                    # 二进制帧：看第一个字节就知道类型，不用解析 JSON
+                    kind = raw[0] if raw else None
+                    if kind == wire.K_MESSAGE:
+                        content = sanitize_input(raw[1:].decode("utf-8", "replace"))
+                        if content and await self.admit_message(
+                            websocket, conn_bucket, nickname
+                        ):
+                            await self.broadcast_message(
+                                join_key, nickname, content, "message", durable=True
+                            )
+                    elif kind == wire.K_PING:
+                        await self.send_pong(websocket, join_key, wire.PONG_FRAME)
+                    elif kind == wire.K_PRESENCE_SYNC:
+                        self._send_presence_snapshot(join_key)
+                    elif kind == wire.K_QUIT:
+                        break
+                    continue
+
                 # 检查是否为退出指令
                 try:
-                    data = json.loads(raw)
+                    data = wire.loads(raw)
                     is_dict = isinstance(data, dict)
-                except json.JSONDecodeError:
+                except ValueError:
                     data = None
                     is_dict = False
 
                 if is_dict:
                     if data.get("type") == "ping":
-                        await websocket.send(json.dumps({"type": "pong"}))
+                        await self.send_pong(
+                            websocket, join_key, wire.dumps({"type": "pong"})
+                        )
+                        continue
+                    if data.get("type") == "presence_sync":
+                        # 客户端发现 presence_delta 的 version 跳号了
+                        self._send_presence_snapshot(join_key)
+                        continue
+                    if data.get("type") in ("history_before", "search") and self.overloaded():
+                        # 翻页、搜索要查库，过载时先拒掉，客户端稍后重试
+                        SHED_TOTAL.inc(frame=data["type"])
+                        await websocket.send(
+                            wire.dumps({"type": "overloaded", "retry_after": 1})
+                        )
+                        continue
+                    if data.get("type") == "history_before":
+                        # 向前翻页：{"type": "history_before", "before_id": 123, "limit": 50}
+                        try:
+                            before_id = data.get("before_id")
+                            before_id = int(before_id) if before_id is not None else None
+                        except (TypeError, ValueError):
+                            before_id = None
+                        page = await self.load_history_page(
+                            before_id, data.get("limit")
+                        )
+                        page["type"] = "history_page"
+                        await websocket.send(wire.dumps(page))
+                        continue
+                    if data.get("type") == "search":
+                        # 全文搜索：{"type": "search", "q": "火锅", "before_id": 123, "limit": 20}
+                        q = data.get("q")
+                        try:
+                            before_id = data.get("before_id")
+                            before_id = int(before_id) if before_id is not None else None
+                            result = await run_search(
+                                self._read_fetchall, q, before_id,
+                                data.get("limit"), data.get("nickname"),
+                            )
+                        except (TypeError, ValueError) as e:
+                            result = {"error": str(e)}
+                        result.update(type="search_results", q=q)
+                        await websocket.send(wire.dumps(result))
                         continue
                     if data.get("action") == "quit":
                         break
                     elif "content" in data:
                         content = sanitize_input(data["content"])
-                        if content:
+                        if content and await self.admit_message(
+                            websocket, conn_bucket, nickname
+                        ):
+                            # 等落盘拿到 id 再广播，客户端才能用 id 做翻页游标
                             await self.broadcast_message(
-                                join_key, nickname, content, "message"
+                                join_key, nickname, content, "message", durable=True
                             )
                 else:
                     content = str(sanitize_input(raw))
-                    await self.broadcast_message(join_key, nickname, content, "message")
+                    if await self.admit_message(websocket, conn_bucket, nickname):
+                        await self.broadcast_message(
+                            join_key, nickname, content, "message", durable=True
+                        )
 
         except (ConnectionClosedOK, ConnectionClosed):
             pass
@@ -317,22 +769,28 @@ class MyWebSS:
                 if join_key in self.clients:
                     _, current_nick = self.clients[join_key]
                     del self.clients[join_key]
+                    self.fanout.unregister(join_key)
+                    self.binary_keys.discard(join_key)
                     # 只有当 nick_to_key 指向当前 join_key 时才删除（防止被新连接覆盖后误删）
                     if self.nick_to_key.get(current_nick) == join_key:
                         del self.nick_to_key[current_nick]
 
             await self.save_login_status_to_DB("logout", join_key, nickname, _now())
-            logger.info(f"{nickname} has left the chat")
-            await self.broadcast_message(
-                join_key, nickname, f"{nickname} has left the chat", "system"
-            )
+            _log_event("%s has left the chat", nickname)
             await self.broadcast_online_list()
 
 
 if __name__ == "__main__":
     asyncio.run(_init_db())
-    server = MyWebSS("127.0.0.1", 8099)
+    # CHATROOM_WORKERS > 1 时多进程共用端口，靠 cluster.py 里的 hub 互相转发
+    workers = int(os.environ.get("CHATROOM_WORKERS", "1"))
     try:
-        asyncio.run(server.start_server())
+        if workers > 1:
+            from cluster import run_cluster
+
+            run_cluster("127.0.0.1", 8099, workers)
+        else:
+            server = MyWebSS("127.0.0.1", 8099)
+            asyncio.run(server.start_server())
     except KeyboardInterrupt:
         logger.info("Server stopped by user.")
@@ -0,0 +1,179 @@
+import json
+import os
+import struct
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 线上帧格式。握手时用 WebSocket 子协议协商：
+#   Sec-WebSocket-Protocol: xbz.bin.v1  -> 聊天消息、在线列表、pong 走下面的二进制帧
+#   不带子协议或 xbz.json.v1            -> 和以前一样全是 JSON 文本帧
+# 二进制客户端照样会收到 JSON 文本帧（welcome、history、history_page 这类低频消息），
+# 按 WebSocket 的 opcode（文本/二进制）区分即可。
+#
+# 二进制帧第一个字节是类型，整数都是网络字节序：
+#   K_MESSAGE / K_SYSTEM  B kind | H nick_id | q message_id(-1=无) | Q 毫秒时间戳 | UTF-8 内容
+#   K_ONLINE              B kind | I version | 用户表
+#   K_PRESENCE_DELTA      B kind | I version | 用户表(added) | 用户表(removed)
+#   K_PONG                B kind
+# 用户表：H 人数 | 每人 H nick_id + B 长度 + UTF-8 昵称。version 的含义见 presence.py。
+# 昵称只在在线列表 / delta 里出现，消息里用 nick_id 引用；服务端保证发言的人先出现在
+# 在线列表里、再发他的消息。系统消息不引用昵称（nick_id = NO_NICK）。
+# 客户端发来的二进制帧：K_MESSAGE + UTF-8 内容、K_PING、K_QUIT、K_PRESENCE_SYNC。
+
+SUBPROTOCOL_BINARY = "xbz.bin.v1"
+SUBPROTOCOL_JSON = "xbz.json.v1"
+SUBPROTOCOLS = [SUBPROTOCOL_BINARY, SUBPROTOCOL_JSON]
+
+
+def select_subprotocol(connection, subprotocols):
+    """传给 serve(select_subprotocol=...)。
+
+    websockets 默认在客户端不带子协议时直接 400，浏览器里的老页面就连不上了；
+    这里不带就按 JSON 处理。
+    """
+    for subprotocol in SUBPROTOCOLS:
+        if subprotocol in subprotocols:
+            return subprotocol
+    return None
+
+K_MESSAGE = 0x01
+K_SYSTEM = 0x02
+K_ONLINE = 0x11
+K_PRESENCE_DELTA = 0x12
+K_PING = 0x20
+K_PONG = 0x21
+K_QUIT = 0x22
+K_PRESENCE_SYNC = 0x23
+
+NO_NICK = 0xFFFF
+_EVENT = struct.Struct("!BHqQ")
+_VERSIONED = struct.Struct("!BI")
+_COUNT = struct.Struct("!H")
+_NICK = struct.Struct("!HB")
+PONG_FRAME = bytes([K_PONG])
+EVENT_KINDS = {"message": K_MESSAGE, "system": K_SYSTEM}
+
+# JSON 编解码可替换：默认装了 orjson 就用 orjson，CHATROOM_JSON_CODEC=json 强制用标准库
+JSON_CODEC = os.environ.get("CHATROOM_JSON_CODEC", "auto")
+try:
+    if JSON_CODEC == "json":
+        raise ImportError
+    import orjson
+
+    def dumps(obj) -> str:
+        # orjson 输出 bytes；文本帧要 str
+        return orjson.dumps(obj).decode("utf-8")
+
+    loads = orjson.loads
+    JSON_CODEC = "orjson"
+except ImportError:
+    dumps = json.dumps
+    loads = json.loads
+    JSON_CODEC = "json"
+
+
+class NickTable:
+    """昵称 <-> 小整数 id，同一个 worker 内全局共享，二进制帧里只放 id。
+
+    用满了要重新编号，但不能在编一帧的中途清空（同一帧里前面的 id 就作废了）：
+    调用方编帧前先用 room() 看够不够，不够就 reset()，并给所有二进制连接重发一份
+    完整在线列表，把还在线的人按新编号重新定义一遍，再发这一帧。
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.resets = 0
+
+    def room(self, nicknames: Iterable[str]) -> bool:
+        new = sum(1 for nickname in set(nicknames) if nickname not in self.ids)
+        return len(self.ids) + new <= NO_NICK
+
+    def reset(self):
+        self.ids.clear()
+        self.resets += 1
+
+    def intern(self, nickname: str) -> int:
+        nick_id = self.ids.get(nickname)
+        if nick_id is None:
+            nick_id = self.ids[nickname] = len(self.ids)
+        return nick_id
+
+
+_last_second = ("", 0)
+
+
+def timestamp_ms(time_stamp: str) -> int:
+    """"2026-10-18 19:26:48.105" -> 毫秒时间戳；同一秒内的消息只解析一次日期"""
+    global _last_second
+    prefix = time_stamp[:19]
+    if prefix != _last_second[0]:
+        _last_second = (prefix, int(datetime.fromisoformat(prefix).timestamp()) * 1000)
+    return _last_second[1] + int(time_stamp[20:23] or 0)
+
+
+def encode_event(
+    kind: int, nick_id: int, message_id: Optional[int], ts_ms: int, content: str
+) -> bytes:
+    return _EVENT.pack(
+        kind, nick_id, -1 if message_id is None else message_id, ts_ms
+    ) + content.encode("utf-8")
+
+
+def _encode_users(users: Iterable[Tuple[int, str]]) -> bytes:
+    parts = []
+    for nick_id, nickname in users:
+        name = nickname.encode("utf-8")[:255]
+        parts.append(_NICK.pack(nick_id, len(name)) + name)
+    return _COUNT.pack(len(parts)) + b"".join(parts)
+
+
+def _decode_users(frame: bytes, offset: int) -> Tuple[List[Tuple[int, str]], int]:
+    (count,) = _COUNT.unpack_from(frame, offset)
+    offset += _COUNT.size
+    users: List[Tuple[int, str]] = []
+    for _ in range(count):
+        nick_id, length = _NICK.unpack_from(frame, offset)
+        offset += _NICK.size
+        users.append((nick_id, frame[offset:offset + length].decode("utf-8")))
+        offset += length
+    return users, offset
+
+
+def encode_online(version: int, users: Iterable[Tuple[int, str]]) -> bytes:
+    return _VERSIONED.pack(K_ONLINE, version) + _encode_users(users)
+
+
+def encode_presence_delta(
+    version: int,
+    added: Iterable[Tuple[int, str]],
+    removed: Iterable[Tuple[int, str]],
+) -> bytes:
+    return (
+        _VERSIONED.pack(K_PRESENCE_DELTA, version)
+        + _encode_users(added)
+        + _encode_users(removed)
+    )
+
+
+def decode(frame: bytes) -> dict:
+    """服务端发出的二进制帧 -> dict（测试、压测客户端用）"""
+    kind = frame[0]
+    if kind in (K_MESSAGE, K_SYSTEM):
+        _, nick_id, message_id, ts_ms = _EVENT.unpack_from(frame)
+        return {
+            "kind": kind,
+            "nick_id": nick_id,
+            "id": None if message_id < 0 else message_id,
+            "ts_ms": ts_ms,
+            "content": frame[_EVENT.size:].decode("utf-8"),
+        }
+    if kind == K_ONLINE:
+        _, version = _VERSIONED.unpack_from(frame)
+        users, _ = _decode_users(frame, _VERSIONED.size)
+        return {"kind": kind, "version": version, "users": users}
+    if kind == K_PRESENCE_DELTA:
+        _, version = _VERSIONED.unpack_from(frame)
+        added, offset = _decode_users(frame, _VERSIONED.size)
+        removed, _ = _decode_users(frame, offset)
+        return {"kind": kind, "version": version, "added": added, "removed": removed}
+    return {"kind": kind}
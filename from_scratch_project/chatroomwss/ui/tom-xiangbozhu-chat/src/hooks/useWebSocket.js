@@ -11,11 +11,21 @@ export const useWebSocket = ({
   onMessage,
   onOnlineUsers,
   onHistory,
+  onResync,
   onOpen,
   onClose,
 }) => {
   const wsRef = useRef(null);
   const historyBufferRef = useRef([]);
+  // 看到的最后一条消息 id，重连时带上，服务端只补发缺的（不随重连清空）
+  const lastIdRef = useRef(null);
+  const trackId = (id) => {
+    if (id != null && (lastIdRef.current === null || id > lastIdRef.current)) {
+      lastIdRef.current = id;
+    }
+  };
+  // 在线列表：连上时收到带 version 的快照，之后按 presence_delta 增量更新
+  const presenceRef = useRef({ version: null, users: [], syncing: false });
 
   const connect = useCallback(() => {
     if (
@@ -26,6 +36,7 @@ export const useWebSocket = ({
     }
 
     historyBufferRef.current = [];
+    presenceRef.current = { version: null, users: [], syncing: false };
     if (wsRef.current) {
       wsRef.current.close();
     }
@@ -63,9 +74,14 @@ export const useWebSocket = ({
 
     ws.onopen = () => {
       console.log("✅ WebSocket connected");
-      ws.send(JSON.stringify({ nickname }));
+      const resuming = lastIdRef.current !== null;
+      ws.send(
+        JSON.stringify(
+          resuming ? { nickname, last_id: lastIdRef.current } : { nickname },
+        ),
+      );
       startHeartbeat();
-      if (onOpen) onOpen();
+      if (onOpen) onOpen(resuming);
     };
 
     ws.onmessage = (event) => {
@@ -79,12 +95,64 @@ export const useWebSocket = ({
       }
 
       if (data.type === "online_users") {
+        presenceRef.current = {
+          version: data.version ?? null,
+          users: data.users,
+          syncing: false,
+        };
         if (onOnlineUsers) onOnlineUsers(data.users);
+      } else if (data.type === "presence_delta") {
+        const presence = presenceRef.current;
+        // 还没收到快照，或者是快照之前的旧 delta：忽略
+        if (presence.version === null || data.version <= presence.version) return;
+        if (data.version !== presence.version + 1) {
+          // 中间丢了帧，要一份完整快照
+          if (!presence.syncing) {
+            presence.syncing = true;
+            ws.send(JSON.stringify({ type: "presence_sync" }));
+          }
+          return;
+        }
+        const removed = new Set(data.removed);
+        const users = presence.users.filter((u) => !removed.has(u));
+        data.added.forEach((u) => {
+          if (!users.includes(u)) users.push(u);
+        });
+        presenceRef.current = { version: data.version, users, syncing: false };
+        if (onOnlineUsers) onOnlineUsers(users);
       } else if (data.type === "history") {
-        historyBufferRef.current.push(data);
-        //if (onHistory) onHistory([...historyBufferRef.current]);
-        if (onHistory) onHistory(data);
+        // 服务端一帧下发整段历史：{ type: "history", messages: [...] }
+        const items = Array.isArray(data.messages)
+          ? data.messages.map((m) => ({ ...m, type: "history" }))
+          : [data];
+        items.forEach((item) => {
+          trackId(item.id);
+          historyBufferRef.current.push(item);
+          //if (onHistory) onHistory([...historyBufferRef.current]);
+          if (onHistory) onHistory(item);
+        });
+      } else if (data.type === "resume") {
+        // 断线期间错过的消息，接在现有列表后面
+        data.messages.forEach((m) => {
+          trackId(m.id);
+          if (onMessage) onMessage({ ...m, type: "message" });
+        });
+      } else if (data.type === "resync") {
+        // 缺得太多，服务端接着会发一帧完整的 history
+        lastIdRef.current = null;
+        historyBufferRef.current = [];
+        if (onResync) onResync();
+      } else if (data.type === "throttled") {
+        // 服务端限流丢掉了刚发的消息，本地提示一下
+        if (onMessage)
+          onMessage({
+            type: "system",
+            id: null,
+            content: "发言太快了，刚才的消息没有发出去",
+            timestamp: data.timestamp,
+          });
       } else if (data.type === "message" || data.type === "system") {
+        if (data.type === "message") trackId(data.id);
         if (onMessage) onMessage(data);
       }
     };
@@ -101,7 +169,7 @@ export const useWebSocket = ({
     };
 
     return ws;
-  }, [nickname, onMessage, onOnlineUsers, onHistory, onOpen, onClose]);
+  }, [nickname, onMessage, onOnlineUsers, onHistory, onResync, onOpen, onClose]);
 
   // 页面可见性检测：iOS 后台恢复
   const testConnectionAndReconnectIfNeeded = useCallback(() => {
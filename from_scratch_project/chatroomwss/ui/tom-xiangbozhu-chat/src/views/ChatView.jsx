@@ -25,16 +25,29 @@ export default function ChatView({ nickname, onLogout }) {
     connect: wsConnect,
   } = useWebSocket({
     nickname,
-    onMessage: (msg) => setMessages((prev) => [...prev, msg]),
+    // 重连补发和实时广播可能同时带来同一条消息，按 id 去重
+    onMessage: (msg) =>
+      setMessages((prev) =>
+        msg.id != null && prev.some((m) => m.id === msg.id)
+          ? prev
+          : [...prev, msg],
+      ),
     onOnlineUsers: (users) => setOnlineUsers(users),
     onHistory: (msg) => {
       historyBufferRef.current.push(msg);
       setMessages([...historyBufferRef.current]);
     },
-    onOpen: () => {
+    onOpen: (resuming) => {
+      // 续传时保留已有消息，服务端只补发缺的
+      if (!resuming) {
+        historyBufferRef.current = [];
+        setMessages([]);
+      }
+      setReconnecting(false);
+    },
+    onResync: () => {
       historyBufferRef.current = [];
       setMessages([]);
-      setReconnecting(false);
     },
     onClose: () => {
       setReconnecting(true);
@@ -166,21 +179,27 @@ export default function ChatView({ nickname, onLogout }) {
                     {msg.content.startsWith("[img:") &&
                     msg.content.endsWith("]") ? (
                       <div className="image-message">
-                        <img
-                          src={`/xbzchat/v1/image/${msg.content.slice(5, -1)}`}
-                          alt="聊天图片"
-                          loading="lazy"
-                          onLoad={() => {
-                            // 图片加载完成后，再尝试滚动到底部
-                            messagesEndRef.current?.scrollIntoView({
-                              behavior: "auto",
-                            });
-                          }}
-                          onError={(e) => {
-                            e.target.alt = "图片加载失败";
-                            e.target.style.opacity = "0.6";
-                          }}
-                        />
+                        <a
+                          href={`/xbzchat/v1/image/${msg.content.slice(5, -1)}`}
+                          target="_blank"
+                          rel="noreferrer"
+                        >
+                          <img
+                            src={`/xbzchat/v1/image/${msg.content.slice(5, -1)}?size=medium`}
+                            alt="聊天图片"
+                            loading="lazy"
+                            onLoad={() => {
+                              // 图片加载完成后，再尝试滚动到底部
+                              messagesEndRef.current?.scrollIntoView({
+                                behavior: "auto",
+                              });
+                            }}
+                            onError={(e) => {
+                              e.target.alt = "图片加载失败";
+                              e.target.style.opacity = "0.6";
+                            }}
+                          />
+                        </a>
                       </div>
                     ) : (
                       msg.content
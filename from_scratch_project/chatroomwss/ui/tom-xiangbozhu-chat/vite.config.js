@@ -19,6 +19,18 @@ export default defineConfig({
         changeOrigin: true,
         //rewrite: (path) => path.replace(/^\/xbzchat\/ws/, '/ws'),
       },
+      "/xbzchat/v1/metrics": {
+        target: "http://localhost:8099",
+        changeOrigin: true,
+      },
+      "/xbzchat/v1/history": {
+        target: "http://localhost:8098",
+        changeOrigin: true,
+      },
+      "/xbzchat/v1/search": {
+        target: "http://localhost:8098",
+        changeOrigin: true,
+      },
       "/xbzchat/v1/upload_image": {
         target: "http://localhost:8098",
         ws: true,
@@ -1,5 +1,19 @@
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from collections import OrderedDict
+import asyncio
+import gzip
+import http.client
+import inspect
+import mimetypes
+import os
+import posixpath
+import urllib.parse
+import queue
+import selectors
+import signal
 import sys
+import threading
+import time
 from datetime import datetime
 import socket
 import io
@@ -9,11 +23,114 @@ import json
 # for post, we directly return the parsing JSON res
 __version__ = "1.0"
 
+_BODY_PIECE = 65536
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class _BadFraming(ValueError):
+    """Content-Length or a chunk-size line that is not a number: 400."""
+
+
+def _content_length(headers):
+    value = headers.get("Content-Length", "0")
+    try:
+        length = int(value)
+    except ValueError:
+        raise _BadFraming(f"Bad Content-Length: {value!r}") from None
+    if length < 0:
+        raise _BadFraming(f"Bad Content-Length: {value!r}")
+    return length
+
+
+def _chunk_size(line):
+    try:
+        size = int(line.split(b";")[0], 16)
+    except ValueError:
+        raise _BadFraming(f"Bad chunk size: {line[:32]!r}") from None
+    if size < 0:
+        raise _BadFraming(f"Bad chunk size: {line[:32]!r}")
+    return size
+
+
+_COMPRESSIBLE_TYPES = ("application/javascript", "application/json", "image/svg+xml")
+
+
+class _StaticCache():
+    """LRU of small static files and their gzip variants, keyed by path.
+
+    An entry is only used while the file's (mtime, size) still match, so an
+    edited file is picked up on the next request.
+    """
+
+    def __init__(self, max_bytes=32 << 20, max_file_size=256 << 10):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.entries = OrderedDict()  # {path: ((mtime_ns, size), body, gz)}
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, st):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != (st.st_mtime_ns, st.st_size):
+                return None
+            self.entries.move_to_end(path)
+            return entry
+
+    def put(self, path, st, body, gz):
+        entry = ((st.st_mtime_ns, st.st_size), body, gz)
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.bytes -= len(old[1]) + len(old[2] or b"")
+            self.entries[path] = entry
+            self.bytes += len(body) + len(gz or b"")
+            while self.bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.bytes -= len(old[1]) + len(old[2] or b"")
+        return entry
+
+
+_STATIC_CACHE = _StaticCache()
+
+
+def _etag(st):
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _open_gzip_sidecar(path, st):
+    """A precompressed `<path>.gz` that is at least as new as the file."""
+    try:
+        gz_file = open(path + ".gz", "rb")
+    except OSError:
+        return None
+    if os.fstat(gz_file.fileno()).st_mtime_ns < st.st_mtime_ns:
+        gz_file.close()
+        return None
+    return gz_file
 
 
 class MyHTTPRequestHandler(BaseHTTPRequestHandler):
 
     server_version = "MyHTTPRequestHandler/" + __version__
+    # keep-alive (protocol_version HTTP/1.1): an idle connection is closed
+    # after `timeout` seconds, and after max_requests_per_connection requests
+    timeout = 15
+    max_requests_per_connection = 100
+    # headers and body go out in two writes; without TCP_NODELAY a reused
+    # connection stalls on Nagle + delayed ACK
+    disable_nagle_algorithm = True
+    # POST /json is read whole, up to max_body_size; /json/batch streams
+    # NDJSON and applies max_body_size to each record, max_batch_size overall
+    max_body_size = 1 << 20
+    max_batch_size = 256 << 20
+    # files under static_root are served at static_prefix, e.g. the built
+    # chat UI: STATIC_ROOT=../../chatroomwss/ui/tom-xiangbozhu-chat/dist
+    static_root = os.environ.get("STATIC_ROOT", "static")
+    static_prefix = "/static/"
     GET_ROUTES = {
     "/time": "_handle_time",
     "/now": "_handle_now",
@@ -24,6 +141,54 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
         super().__init__(*args, **kwargs)
         self.start_time = datetime.now().__str__()
     
+    def setup(self):
+        super().setup()
+        self.requests_handled = 0
+
+    def handle_one_request(self):
+        if self.requests_handled and not self._wait_for_next_request():
+            self.close_connection = True
+            return
+        self.requests_handled += 1
+        super().handle_one_request()
+
+    def _wait_for_next_request(self):
+        """Between keep-alive requests under PoolHTTPServer: False when the
+        worker should rather serve a queued connection than keep waiting."""
+        wait_readable = getattr(self.server, "wait_readable", None)
+        if wait_readable is None:
+            return True
+        # a pipelined request may already sit in rfile's buffer, where
+        # select() cannot see it; peek without blocking
+        timeout = self.connection.gettimeout()
+        self.connection.setblocking(False)
+        try:
+            if self.rfile.peek(1):
+                return True
+        finally:
+            self.connection.settimeout(timeout)
+        return wait_readable(self.connection, self.timeout)
+
+    def end_headers(self):
+        # every response carries Content-Length, so the connection can be reused
+        if self.protocol_version >= "HTTP/1.1" and not self.close_connection:
+            left = self.max_requests_per_connection - self.requests_handled
+            busy = getattr(self.server, "busy", None)
+            # connections waiting for a pool worker go first
+            if left <= 0 or (busy is not None and busy()):
+                self.send_header("Connection", "close")
+            else:
+                self.send_header("Keep-Alive", f"timeout={self.timeout}, max={left}")
+        super().end_headers()
+
+    def _send_json(self, out_put_json, code=200):
+        encoded = json.dumps(out_put_json).encode('utf-8', 'surrogateescape')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
     def _get_now(self):
         return datetime.now().__str__()
     
@@ -46,17 +211,20 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
             print("i'm in tiashi path")
             self.send_response_only(520)
             #self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", "0")
             self.end_headers()
             return 
         
+        elif self.path.startswith(self.static_prefix):
+            self._handle_static()
+
+        elif self.path == "/server_stats" and hasattr(self.server, "stats"):
+            self._send_json(self.server.stats())
+
         elif handler_name and hasattr(self, handler_name):
             response = getattr(self, handler_name)()
             out_put_json = {"current_time": response}
-            encoded = json.dumps(out_put_json).encode('utf-8', 'surrogateescape')
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(encoded)
+            self._send_json(out_put_json)
 
 
         elif self.path == '/':
@@ -64,40 +232,647 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
             print(f"I'm sending GET resonese")
             #f = io.BytesIO()
             out_put_json = {"current_time": time_now}
-            encoded = json.dumps(out_put_json).encode('utf-8', 'surrogateescape')
             #f.write(encoded)
             #f.seek(0)
             #self.send_response_only(200, f"time is {time_now}")
-            self.send_response(200)
-            #, f"time is {time_now}")
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(encoded)
+            self._send_json(out_put_json)
         else:
             self.send_error(404)
         return True
 
+    def _static_path(self):
+        """Map the URL to a file under static_root, or None if it escapes it."""
+        url_path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        rel = posixpath.normpath(url_path[len(self.static_prefix):]).lstrip("/")
+        root = os.path.realpath(self.static_root)
+        path = os.path.realpath(os.path.join(root, rel))
+        if os.path.commonpath([root, path]) != root:
+            return None
+        if os.path.isdir(path):
+            path = os.path.join(path, "index.html")
+        return path
+
+    def _parse_range(self, st):
+        """A single `bytes=` range as (start, end) inclusive, "unsatisfiable",
+        or None to send the whole file (no Range, multiple ranges, stale If-Range)."""
+        spec = self.headers.get("Range", "")
+        if not spec.startswith("bytes=") or "," in spec:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range != _etag(st):
+            return None
+        size = st.st_size
+        first, _, last = spec[6:].strip().partition("-")
+        try:
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+                end = size - 1
+        except ValueError:
+            return None
+        if start > end or start >= size:
+            return "unsatisfiable"
+        return start, end
+
+    def _sendfile(self, f, offset, count):
+        if hasattr(self.wfile, "sendfile"):
+            self.wfile.sendfile(f, offset, count)
+        else:
+            # socket.sendfile uses os.sendfile and copes with the socket timeout
+            self.connection.sendfile(f, offset, count)
+
+    def _handle_static(self):
+        """Serve a file: small ones from _STATIC_CACHE, the rest with sendfile.
+
+        gzip is used when the client accepts it and the whole file is asked
+        for: from the cache, or from a `<file>.gz` next to a large file.
+        """
+        path = self._static_path()
+        try:
+            f = open(path, "rb") if path else None
+        except OSError:
+            f = None
+        if f is None:
+            self.send_error(404)
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            ctype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            rng = self._parse_range(st)
+            if rng == "unsatisfiable":
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{st.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            accepts_gzip = rng is None and "gzip" in self.headers.get("Accept-Encoding", "")
+
+            entry = None
+            if st.st_size <= _STATIC_CACHE.max_file_size:
+                entry = _STATIC_CACHE.get(path, st)
+                if entry is None:
+                    body = f.read()
+                    gz = None
+                    if ctype.startswith("text/") or ctype in _COMPRESSIBLE_TYPES:
+                        gz = gzip.compress(body, 6, mtime=0)
+                        if len(gz) >= len(body):
+                            gz = None
+                    entry = _STATIC_CACHE.put(path, st, body, gz)
+
+            source, gz_file, etag = f, None, _etag(st)
+            if accepts_gzip and entry is not None and entry[2] is not None:
+                body, etag = entry[2], etag[:-1] + '-gz"'
+            elif accepts_gzip and entry is None:
+                gz_file = _open_gzip_sidecar(path, st)
+                if gz_file is not None:
+                    source, etag = gz_file, etag[:-1] + '-gz"'
+            elif entry is not None:
+                body = entry[1]
+
+            try:
+                if etag in self.headers.get("If-None-Match", "") or self.headers.get("If-None-Match") == "*":
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+
+                length = os.fstat(source.fileno()).st_size if entry is None else len(body)
+                offset = 0
+                self.send_response(200 if rng is None else 206)
+                self.send_header("Content-Type", ctype)
+                if rng is not None:
+                    offset, length = rng[0], rng[1] - rng[0] + 1
+                    self.send_header("Content-Range", f"bytes {rng[0]}-{rng[1]}/{st.st_size}")
+                if etag.endswith('-gz"'):
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(length))
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                if entry is not None:
+                    self.wfile.write(body[offset:offset + length])
+                else:
+                    self._sendfile(source, offset, length)
+            finally:
+                if gz_file is not None:
+                    gz_file.close()
+
+    def _streams_body(self):
+        # /json/batch reads its body as it goes (see _iter_records)
+        return self.command == "POST" and self.path == "/json/batch"
+
+    def _iter_body(self, limit):
+        """Yield the request body piece by piece, from Content-Length or
+        Transfer-Encoding: chunked, raising _BodyTooLarge past `limit`."""
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            total = 0
+            while True:
+                size = _chunk_size(self.rfile.readline(_BODY_PIECE))
+                if size == 0:
+                    # skip trailers up to the blank line
+                    while self.rfile.readline(_BODY_PIECE) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                total += size
+                if total > limit:
+                    raise _BodyTooLarge(total)
+                yield from self._iter_exactly(size)
+                self.rfile.readline(_BODY_PIECE)
+        else:
+            length = _content_length(self.headers)
+            if length > limit:
+                raise _BodyTooLarge(length)
+            yield from self._iter_exactly(length)
+
+    def _iter_exactly(self, left):
+        while left > 0:
+            data = self.rfile.read(min(left, _BODY_PIECE))
+            if not data:
+                raise ValueError("request body truncated")
+            left -= len(data)
+            yield data
+
+    def _read_body(self, limit):
+        return b"".join(self._iter_body(limit))
+
+    def _iter_records(self):
+        """Split an NDJSON body into lines without holding more than one
+        record (at most max_body_size) plus one read piece in memory."""
+        pending = b""
+        for data in self._iter_body(self.max_batch_size):
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            if len(pending) > self.max_body_size:
+                raise _BodyTooLarge(len(pending))
+            yield lines
+        if pending:
+            yield [pending]
+
+    def _annotate(self, js_data):
+        if not isinstance(js_data, dict):
+            raise ValueError("expected a JSON object")
+        js_data['time_now'] = self._handle_now()
+        return js_data
+
+    def _handle_json_batch(self):
+        """Read newline-delimited JSON and answer each record as soon as the
+        piece of body containing it has been read; the reply is NDJSON too."""
+        if "chunked" not in self.headers.get("Transfer-Encoding", "").lower():
+            # a bad Content-Length can still get a proper 400; a bad chunk
+            # size turns up after the 200 and is reported in-band
+            try:
+                _content_length(self.headers)
+            except _BadFraming as e:
+                self.send_error(400, str(e))
+                return
+        chunked = self.request_version == "HTTP/1.1" and self.protocol_version >= "HTTP/1.1"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+        def write(out):
+            if chunked:
+                out = b"%x\r\n%s\r\n" % (len(out), out)
+            self.wfile.write(out)
+
+        line_no = 0
+        try:
+            for lines in self._iter_records():
+                out = []
+                for line in lines:
+                    line_no += 1
+                    if not line.strip():
+                        continue
+                    try:
+                        result = self._annotate(json.loads(line))
+                    except ValueError as e:
+                        result = {"error": str(e), "line": line_no}
+                    out.append(json.dumps(result).encode('utf-8', 'surrogateescape') + b"\n")
+                if out:
+                    write(b"".join(out))
+        except (_BodyTooLarge, ValueError) as e:
+            # the status line is already out; report in-band and drop the connection
+            error = "record too large" if isinstance(e, _BodyTooLarge) else str(e)
+            write(json.dumps({"error": error, "line": line_no + 1}).encode() + b"\n")
+            self.close_connection = True
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
     # return a json with new attr
     def do_POST(self) -> bool:
         if self.path == "/json":
-            #json.loads(self.requestline)
-            content_length = int(self.headers.get('Content-Length', 0))
-            #print(self.headers, content_length)
-            raw_data = self.rfile.read(content_length)
-            js_data = json.loads(raw_data)
-            js_data['time_now'] = self._handle_now()
-            encoded = json.dumps(js_data).encode('utf-8', 'surrogateescape')
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(encoded)
-            #print("this is a debug", raw_data)
-            pass
+            try:
+                js_data = self._annotate(json.loads(self._read_body(self.max_body_size)))
+            except _BodyTooLarge:
+                self.send_error(413)
+                return True
+            except _BadFraming as e:
+                self.send_error(400, str(e))
+                return True
+            except ValueError as e:
+                self.send_error(400, f"Bad JSON body: {e}")
+                return True
+            self._send_json(js_data)
+
+        elif self.path == "/json/batch":
+            self._handle_json_batch()
+
         else:
             self.send_error(404)
 
         return True
 
+_SERVICE_UNAVAILABLE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: close\r\n\r\n"
+)
+
+
+# like socketserver: poll() has no FD_SETSIZE limit
+_IdleSelector = getattr(selectors, "PollSelector", selectors.SelectSelector)
+
+
+class PoolHTTPServer(HTTPServer):
+    """HTTPServer with a fixed pool of worker threads and a bounded accept queue.
+
+    ThreadingHTTPServer starts a new thread for every connection. Here
+    pool_size threads serve connections taken from a queue of at most
+    accept_queue_size; once it is full, new connections get a 503 and are
+    closed instead of piling up more threads.
+    """
+
+    pool_size = 32
+    accept_queue_size = 128
+    # a worker idling on a keep-alive connection checks this often whether
+    # other connections are queued, and if so closes the idle one
+    idle_poll_interval = 0.05
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._requests = queue.Queue(self.accept_queue_size)
+        self._workers = []
+        self.accepted = 0
+        self.rejected = 0
+
+    def serve_forever(self, poll_interval=0.5):
+        # threads are started here, not in __init__, so PreForkHTTPServer
+        # can fork first and give every child its own pool
+        for _ in range(self.pool_size):
+            worker = threading.Thread(target=self._worker, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        super().serve_forever(poll_interval)
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self.rejected += 1
+            try:
+                request.sendall(_SERVICE_UNAVAILABLE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.accepted += 1
+
+    def busy(self):
+        return not self._requests.empty()
+
+    def wait_readable(self, sock, timeout):
+        """Wait up to timeout for sock to become readable; give up early when
+        another connection is queued for a worker."""
+        deadline = time.monotonic() + timeout
+        with _IdleSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ)
+            while True:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                if selector.select(min(left, self.idle_poll_interval)):
+                    return True
+                if self.busy():
+                    return False
+
+    def stats(self):
+        return {
+            "pid": os.getpid(),
+            "pool_size": self.pool_size,
+            "queue_depth": self._requests.qsize(),
+            "accept_queue_size": self.accept_queue_size,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+        }
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            try:
+                self._requests.put_nowait(None)
+            except queue.Full:
+                break
+
+
+class PreForkHTTPServer(PoolHTTPServer):
+    """Bind and listen once, then fork `processes` children that all accept()
+    on the shared listening socket.
+
+    Each child runs its own (smaller) worker pool, so CPU-bound handlers such
+    as POST /json use every core instead of contending for one GIL. Counters
+    from /server_stats are per child.
+    """
+
+    processes = os.cpu_count() or 2
+    pool_size = 8
+
+    def serve_forever(self, poll_interval=0.5):
+        children = []
+        for _ in range(self.processes):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    super().serve_forever(poll_interval)
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        print(f"[DEBUG] pre-forked {len(children)} workers: {children}")
+        try:
+            for pid in children:
+                os.waitpid(pid, 0)
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except (ProcessLookupError, ChildProcessError):
+                    pass
+
+
+SERVER_CLASSES = {
+    "threading": ThreadingHTTPServer,
+    "pool": PoolHTTPServer,
+    "prefork": PreForkHTTPServer,
+}
+
+
+class MyAsyncHTTPServer():
+    """HTTP/1.1 server on one asyncio event loop, driven by a handler class.
+
+    An idle keep-alive connection is a suspended coroutine instead of a
+    parked thread, so tens of thousands of them fit on one thread. Paths in
+    HandlerClass.GET_ROUTES are dispatched directly; the `_handle_*` method
+    may be a plain function or `async def`. Everything else falls back to
+    the handler's own do_GET/do_POST, run against an in-memory request.
+    """
+
+    def __init__(self, address, port, HandlerClass, backlog=4096,
+                 max_header_size=65536):
+        self.server_address = (address, port)
+        self.HandlerClass = HandlerClass
+        self.request_queue_size = backlog
+        self.max_header_size = max_header_size
+        self.timeout = HandlerClass.timeout
+        self.max_requests_per_connection = HandlerClass.max_requests_per_connection
+        self.connections = 0
+        self.requests = 0
+
+    def stats(self):
+        return {
+            "pid": os.getpid(),
+            "connections": self.connections,
+            "requests": self.requests,
+        }
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        client_address = writer.get_extra_info("peername")
+        requests_handled = 0
+        try:
+            while requests_handled < self.max_requests_per_connection:
+                try:
+                    # readuntil scans the buffer as bytes arrive; the head is
+                    # only parsed once the blank line is in
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), self.timeout)
+                except (asyncio.IncompleteReadError, TimeoutError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(_simple_response(431, "Request Header Fields Too Large"))
+                    break
+                requests_handled += 1
+                self.requests += 1
+                handler = self._make_handler(head, client_address, writer, requests_handled)
+                if handler is None:
+                    writer.write(_simple_response(400, "Bad Request"))
+                    break
+                if handler._streams_body():
+                    await self._dispatch_streaming(reader, writer, handler)
+                else:
+                    try:
+                        await self._read_body(reader, handler)
+                    except _BodyTooLarge:
+                        writer.write(_simple_response(413, "Content Too Large"))
+                        break
+                    except _BadFraming:
+                        writer.write(_simple_response(400, "Bad Request"))
+                        break
+                    await self._dispatch(handler)
+                if handler.wfile.pending_file is not None:
+                    f, offset, count = handler.wfile.pending_file
+                    with f:
+                        await asyncio.get_running_loop().sendfile(
+                            writer.transport, f, offset, count)
+                await writer.drain()
+                if handler.close_connection:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError,
+                TimeoutError) as e:
+            print(f"[DEBUG] {client_address} has error {e!r}")
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _read_body(self, reader, handler):
+        """do_POST is synchronous, so the body is read here first (chunked is
+        decoded) and handed over as a Content-Length body in rfile."""
+        limit = handler.max_body_size
+        if "chunked" in handler.headers.get("Transfer-Encoding", "").lower():
+            pieces = []
+            total = 0
+            while True:
+                size = _chunk_size(await reader.readline())
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                total += size
+                if total > limit:
+                    raise _BodyTooLarge(total)
+                pieces.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(pieces)
+            del handler.headers["Transfer-Encoding"]
+            handler.headers["Content-Length"] = str(len(body))
+        else:
+            length = _content_length(handler.headers)
+            if length > limit:
+                raise _BodyTooLarge(length)
+            body = await reader.readexactly(length) if length else b""
+        handler.rfile = io.BytesIO(body)
+
+    async def _dispatch_streaming(self, reader, writer, handler):
+        """Run do_POST on a worker thread with rfile/wfile bridged to this
+        connection, so a body of up to max_batch_size is never held in
+        memory and parsing it does not stall the loop."""
+        loop = asyncio.get_running_loop()
+        handler.rfile = _ReaderFile(reader, loop, self.timeout)
+        handler.wfile = _ThreadTransportFile(writer, loop, self.timeout)
+        await asyncio.to_thread(handler.do_POST)
+
+    def _make_handler(self, head, client_address, writer, requests_handled):
+        """Build a HandlerClass instance without a socket: rfile/wfile are
+        BytesIO, so send_response/send_header/end_headers work unchanged."""
+        handler = self.HandlerClass.__new__(self.HandlerClass)
+        handler.server = self
+        handler.client_address = client_address
+        handler.rfile = io.BytesIO()
+        handler.wfile = _TransportFile(writer)
+        handler.start_time = datetime.now().__str__()
+        handler.requests_handled = requests_handled
+        requestline, _, header_block = head.partition(b"\r\n")
+        handler.raw_requestline = requestline + b"\r\n"
+        try:
+            words = requestline.decode("iso-8859-1").split()
+            handler.command, handler.path, handler.request_version = words
+            handler.headers = http.client.parse_headers(io.BytesIO(header_block))
+        except (ValueError, http.client.HTTPException):
+            return None
+        handler.requestline = requestline.decode("iso-8859-1")
+        handler.close_connection = (
+            handler.request_version != "HTTP/1.1"
+            or handler.headers.get("Connection", "").lower() == "close"
+        )
+        return handler
+
+    async def _dispatch(self, handler):
+        handler_name = handler.GET_ROUTES.get(handler.path) if handler.command == "GET" else None
+        if handler_name and hasattr(handler, handler_name):
+            response = getattr(handler, handler_name)()
+            if inspect.isawaitable(response):
+                response = await response
+            handler._send_json({"current_time": response})
+            return
+        method = getattr(handler, "do_" + handler.command, None)
+        if method is None:
+            handler.send_error(501, f"Unsupported method ({handler.command!r})")
+            return
+        result = method()
+        if inspect.isawaitable(result):
+            await result
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(
+            self.handle_connection, *self.server_address,
+            backlog=self.request_queue_size, reuse_address=True,
+            limit=self.max_header_size,
+        )
+        for sock in server.sockets:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"Serving HTTP (asyncio) on {host} port {port} (http://{host}:{port}/) ...")
+        async with server:
+            await server.serve_forever()
+
+
+class _TransportFile():
+    """wfile for MyAsyncHTTPServer handlers: writes go to the transport
+    buffer right away, so streamed responses leave as they are produced."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending_file = None
+
+    def sendfile(self, f, offset, count):
+        # the handler closes f when it returns; keep our own descriptor
+        self.pending_file = (os.fdopen(os.dup(f.fileno()), "rb"), offset, count)
+
+    def write(self, data):
+        self.writer.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class _ReaderFile():
+    """Blocking rfile over an asyncio StreamReader, for a handler running
+    on a worker thread; each read waits at most `timeout` seconds."""
+
+    def __init__(self, reader, loop, timeout):
+        self.reader = reader
+        self.loop = loop
+        self.timeout = timeout
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(coro, self.timeout), self.loop).result()
+
+    def read(self, size):
+        return self._call(self.reader.read(size))
+
+    def readline(self, size=-1):
+        # the StreamReader limit (max_header_size) bounds the line instead
+        return self._call(self.reader.readline())
+
+
+class _ThreadTransportFile(_TransportFile):
+    """wfile for a handler on a worker thread: each write is handed to the
+    loop and waits for drain, so a slow client slows the handler down."""
+
+    def __init__(self, writer, loop, timeout):
+        super().__init__(writer)
+        self.loop = loop
+        self.timeout = timeout
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(data), self.loop).result()
+        return len(data)
+
+
+def _simple_response(code, message):
+    return (f"HTTP/1.1 {code} {message}\r\n"
+            "Content-Length: 0\r\nConnection: close\r\n\r\n").encode()
+
+
 def _get_best_family(*address):
     infos = socket.getaddrinfo(
         *address,
@@ -138,10 +913,20 @@ def test(HandlerClass=BaseHTTPRequestHandler,
 
 if __name__ == '__main__':
     handler_class = MyHTTPRequestHandler
+    # python server.py [threading|pool|prefork|asyncio]
+    mode = sys.argv[1] if len(sys.argv) > 1 else "threading"
+    if mode == "asyncio":
+        handler_class.protocol_version = "HTTP/1.1"
+        try:
+            asyncio.run(MyAsyncHTTPServer("127.0.0.1", 8090, handler_class).serve_forever())
+        except KeyboardInterrupt:
+            print("\nKeyboard interrupt received, exiting.")
+        sys.exit(0)
+    server_class = SERVER_CLASSES[mode]
     test(
         HandlerClass=handler_class,
-        ServerClass=ThreadingHTTPServer,
+        ServerClass=server_class,
         port="8090",
         bind="127.0.0.1",
-        protocol="HTTP/1.0",
+        protocol="HTTP/1.1",
     )
\ No newline at end of file